@@ -17,8 +17,13 @@ import argparse
 
 from os.path import join, isdir, isfile, relpath
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
-from src import YAMLConfig, print_rank_0, Task, Agent, serialize
+from src import YAMLConfig, LazyTask, print_rank_0, Task, Agent, serialize
+from src.scheduler import Scheduler
+from src.sink import configure_sinks, close_sinks
+from src.transport import configure_transport, get_transport
+from src.retry import get_retry_stats
 
 
 def parse_args():
@@ -28,6 +33,24 @@ def parse_args():
     group.add_argument("--agent", type=str, required=True, help="Agent config to load")
     group.add_argument("--output_dir", type=str, default="outputs", help="Output root directory")
     group.add_argument("--workers", type=int, default=1, help="Number of workers for evaluation")
+    group.add_argument("--schedule", type=str, default="sequential", choices=["sequential", "global"],
+                       help="'global' runs all tasks at once, sharing --workers across their items")
+    group.add_argument("--prewarm", action="store_true",
+                       help="Build the next task (and its environment) while the current one runs")
+    group.add_argument("--adaptive_concurrency", action="store_true",
+                       help="Adjust each task's concurrency between 1 and --workers from observed latency and errors")
+    group.add_argument("--micro_batch", type=int, default=None,
+                       help="Send up to this many concurrent model calls in one request, for agents that support it")
+    group.add_argument("--micro_batch_wait_ms", type=float, default=20,
+                       help="How long a model call waits for others to fill its batch")
+    group.add_argument("--connect_timeout", type=float, default=None, help="HTTP connect timeout of agents (seconds)")
+    group.add_argument("--read_timeout", type=float, default=None, help="HTTP read timeout of agents (seconds)")
+    group.add_argument("--fsync_interval", type=float, default=None,
+                       help="Seconds between fsync calls on output files, default leaves it to the OS")
+    group.add_argument("--compression", type=str, default=None, choices=["zstd"],
+                       help="Compress jsonl outputs (generation, runs, predictions)")
+    group.add_argument("--resume", type=str, default=None,
+                       help="Output directory of an interrupted run; only items missing from it are predicted")
     args = parser.parse_args()
     return args
 
@@ -45,28 +68,57 @@ def find_all_task_files(all_task_config_path) -> List[str]:
     return tasks
 
 
-def evaluate_all_tasks(tasks: List[Task], agent: Agent):
-    for task in tasks:
+def evaluate_all_tasks(tasks: List[LazyTask], agent: Agent, scheduler: Scheduler = None, prewarm: bool = False):
+    """
+        Each task is built right before it runs and released right after, so only its own environment is up.
+    """
+    if scheduler:
+        def run(lazy_task):
+            task = lazy_task.create()
+            task.set_scheduler(scheduler)
+            task.evaluate(agent)
+            lazy_task.release()
+
+        with ThreadPoolExecutor(max_workers=len(tasks) or 1) as executor:
+            for future in [executor.submit(run, task) for task in tasks]:
+                future.result()
+        return
+    for idx, lazy_task in enumerate(tasks):
+        task = lazy_task.create()
+        if prewarm and idx + 1 < len(tasks):
+            tasks[idx + 1].prewarm()
         task.evaluate(agent)
-        task.release()
+        lazy_task.release()
         del task
 
 
 def main():
     args = parse_args()
+    configure_sinks(fsync_interval=args.fsync_interval, compression=args.compression)
+    configure_transport(pool_size=args.workers, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
     create_time = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    output_root_dir = os.path.join(args.output_dir, create_time)
+    output_root_dir = args.resume or os.path.join(args.output_dir, create_time)
     if not os.path.exists(output_root_dir):
         os.makedirs(output_root_dir)
+    # a resumed run keeps the configs of the run it continues
+    configs_path = os.path.join(output_root_dir, f"configs-resume-{create_time}.json" if args.resume else "configs.json")
 
     task_files = find_all_task_files(args.task)
     tasks = []
 
     print("> Loading task configs")
     for task_config_path in task_files:
-        task = YAMLConfig.create_from_yaml(task_config_path, {"output_root_dir": output_root_dir, "workers": args.workers})
-        if not task.output_root_dir:
-            task.output_root_dir = output_root_dir
+        update = {
+            "output_root_dir": output_root_dir,
+            "workers": args.workers,
+            "resume": bool(args.resume),
+        }
+        if args.adaptive_concurrency and \
+                not YAMLConfig.from_yaml_file(task_config_path).parameters.get("adaptive_concurrency"):
+            update["adaptive_concurrency"] = True  # keep the bounds of tasks that configure their own
+        if args.micro_batch:
+            update["micro_batch"] = {"size": args.micro_batch, "wait_ms": args.micro_batch_wait_ms}
+        task = LazyTask(task_config_path, update)
         # task.workers = args.workers or task.workers
         print(f"    Task '{task.name}' loaded from config {task_config_path}")
         tasks.append(task)
@@ -76,26 +128,35 @@ def main():
     # model, tokenizer = initialize_model_and_tokenizer(args)
     # model = ModelForEvaluation(model, args.position_encoding_2d)
 
-    with open(os.path.join(output_root_dir, "configs.json"), "w") as f:
-        json.dump({
-            "args": args.__dict__,
-            "command_line": sys.argv,
-            "create_time": create_time,
-            "output_root_dir": output_root_dir,
-            "tasks": [{
-                "class": str(type(task)),
-                "fields": serialize(task.__dict__),
-            } for task in tasks],
-            "agent": {
-                "class": str(type(agent)),
-                "fields": serialize(agent.__dict__),
-            },
-        }, f, indent=4)
+    configs = {
+        "args": args.__dict__,
+        "command_line": sys.argv,
+        "create_time": create_time,
+        "output_root_dir": output_root_dir,
+        "tasks": [{
+            "class": task.config.module,
+            "fields": serialize(task.config.parameters),
+        } for task in tasks],
+        "agent": {
+            "class": str(type(agent)),
+            "fields": serialize(agent.__dict__),
+        },
+    }
+    with open(configs_path, "w") as f:
+        json.dump(configs, f, indent=4)
 
     start = time.time()
-    evaluate_all_tasks(tasks, agent)
+    scheduler = Scheduler(args.workers) if args.schedule == "global" else None
+    evaluate_all_tasks(tasks, agent, scheduler, args.prewarm)
+    close_sinks()
     print_rank_0(f"> Finish {len(tasks)} task{'s' if len(tasks) > 1 else ''} in {time.time() - start:.1f}s")
 
+    configs["agent"]["stats"] = agent.get_stats()
+    configs["agent"]["stats"]["transport"] = get_transport().get_stats()
+    configs["agent"]["stats"]["retry"] = get_retry_stats()
+    with open(configs_path, "w") as f:
+        json.dump(configs, f, indent=4)
+
 
 if __name__ == "__main__":
     main()
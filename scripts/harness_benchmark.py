@@ -0,0 +1,169 @@
+"""
+    Measure the overhead of the evaluation runner itself against the simulated model of DoNothingAgent, without a GPU.
+    Runs `Task.predict_all` (thread and asyncio paths), `SingleRoundTask.evaluate` and `CompositeTask.evaluate` at each
+    worker count and reports, per item, the wall time not explained by model latency. Run from the repository root:
+
+        python scripts/harness_benchmark.py --workers 1 10 100 1000 --output bench.json
+        python scripts/harness_benchmark.py --baseline bench.json  # exits with 1 if the overhead regressed
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.configs import YAMLConfig
+from src.sink import close_sinks, read_lines
+from src.timing import percentiles
+from src.tasks.example_task import ExampleTask
+from src.agents.do_nothing_agent import DoNothingAgent
+
+SUITES = ["predict_all_thread", "predict_all_async", "singleround", "composite"]
+
+
+class ThreadExampleTask(ExampleTask):
+    """
+        ExampleTask pinned to the thread pool path of `predict_all`.
+    """
+
+    @property
+    def is_async(self) -> bool:
+        return False
+
+
+def write_yaml(path: str, module: str, parameters: dict) -> str:
+    with open(path, "w") as f:
+        json.dump({"module": module, "parameters": parameters}, f)  # JSON is valid YAML
+    return path
+
+
+def write_singleround_data(root: str, items: int) -> str:
+    os.makedirs(os.path.join(root, "data"), exist_ok=True)
+    with open(os.path.join(root, "data", "questions.jsonl"), "w") as f:
+        for idx in range(items):
+            f.write(json.dumps({"question": f"What is {idx}+1?", "answer": [str(idx + 1)]}) + "\n")
+    return os.path.join(root, "data")
+
+
+def run_suite(suite: str, agent: DoNothingAgent, workers: int, items: int, root: str) -> None:
+    common = {"workers": workers, "output_root_dir": os.path.join(root, "outputs")}
+    singleround = {"name": "singleround", "path": write_singleround_data(root, items), "file_pattern": "*.jsonl",
+                   "metrics": ["ACC"], "acc_type": "EM", "extract_answer": False}
+    example = {"name": "example", "count": items, "range_min": 0, "range_max": 10 ** 9}
+    if suite.startswith("predict_all"):
+        task_class = ThreadExampleTask if suite == "predict_all_thread" else ExampleTask
+        task = task_class(**example, **common)
+        task.predict_all(agent, task.get_data().get_inputs())
+    elif suite == "singleround":
+        YAMLConfig("src.tasks.single_round_tasks.SingleRoundTask", {**singleround, **common}).create().evaluate(agent)
+    elif suite == "composite":
+        write_yaml(os.path.join(root, "example.yaml"), "src.tasks.ExampleTask", {**example, "count": items // 2})
+        write_singleround_data(root, items // 2)
+        write_yaml(os.path.join(root, "singleround.yaml"), "src.tasks.single_round_tasks.SingleRoundTask",
+                   singleround)
+        path = write_yaml(os.path.join(root, "composite.yaml"), "src.tasks.composite_task.CompositeTask", {
+            "name": "composite", "tasks": [{"src": "example.yaml"}, {"src": "singleround.yaml"}],
+        })
+        YAMLConfig.load_from_yaml(path, common).create().evaluate(agent)
+    close_sinks()
+
+
+def measure(suite: str, agent: DoNothingAgent, workers: int, items: int) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        start = time.time()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            run_suite(suite, agent, workers, items, root)
+        wall_time = time.time() - start
+        timings = []
+        for path in glob.glob(os.path.join(root, "outputs", "**", "timings.jsonl*"), recursive=True):
+            timings += [json.loads(line) for line in read_lines(path)]
+    model_times = [sum(call["model_time"] for call in item["calls"]) for item in timings]
+    # the model calls of one task could at best overlap across all its workers
+    ideal_time = sum(model_times) / min(workers, max(1, len(timings)))
+    return {
+        "suite": suite,
+        "workers": workers,
+        "items": len(timings),
+        "wall_time": wall_time,
+        "items_per_sec": len(timings) / wall_time,
+        "overhead_per_item_ms": 1000 * (wall_time - ideal_time) / max(1, len(timings)),
+        "in_item_overhead_ms": {
+            key: 1000 * value for key, value in percentiles([
+                item["duration"] - model_time for item, model_time in zip(timings, model_times)
+            ]).items()
+        },
+        "queue_wait_ms": {key: 1000 * value for key, value in percentiles([
+            item["queue_wait"] for item in timings
+        ]).items()},
+    }
+
+
+def compare(results: list, baseline: list, tolerance: float, floor_ms: float) -> list:
+    """
+        Rows whose overhead per item grew by more than `tolerance` (relative) plus `floor_ms` (absolute, for noise).
+    """
+    previous = {(row["suite"], row["workers"]): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = previous.get((row["suite"], row["workers"]))
+        if old and row["overhead_per_item_ms"] > old["overhead_per_item_ms"] * (1 + tolerance) + floor_ms:
+            regressions.append((row, old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suites", nargs="*", default=SUITES, choices=SUITES)
+    parser.add_argument("--workers", nargs="*", type=int, default=[1, 10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=4, help="Items per worker")
+    parser.add_argument("--min_items", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean simulated model latency (seconds)")
+    parser.add_argument("--latency_std", type=float, default=0.02)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--response_chars", type=int, default=400)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative overhead increase")
+    parser.add_argument("--floor_ms", type=float, default=1.0, help="Allowed absolute overhead increase per item")
+    args = parser.parse_args()
+
+    agent = DoNothingAgent(
+        name="simulator",
+        latency={"distribution": "lognormal", "mean": args.latency, "std": args.latency_std},
+        error_rate=args.error_rate,
+        response_length={"distribution": "normal", "mean": args.response_chars, "std": args.response_chars / 2},
+        retry={"base_delay": 0.01, "max_delay": 0.1},
+        seed=0,
+    )
+    results = []
+    print(f"{'suite':<20}{'workers':>8}{'items':>7}{'wall s':>9}{'items/s':>10}{'overhead ms/item':>18}"
+          f"{'in-item p50/p95 ms':>20}")
+    for suite in args.suites:
+        for workers in args.workers:
+            row = measure(suite, agent, workers, max(args.min_items, workers * args.rounds))
+            results.append(row)
+            in_item = row["in_item_overhead_ms"]
+            print(f"{suite:<20}{workers:>8}{row['items']:>7}{row['wall_time']:>9.2f}{row['items_per_sec']:>10.1f}"
+                  f"{row['overhead_per_item_ms']:>18.3f}{in_item.get('p50', 0):>10.3f}/{in_item.get('p95', 0):.3f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.floor_ms)
+        for row, old in regressions:
+            print(f"Regression: {row['suite']} at {row['workers']} workers, overhead "
+                  f"{old['overhead_per_item_ms']:.3f} -> {row['overhead_per_item_ms']:.3f} ms/item")
+        if regressions:
+            sys.exit(1)
+        print("No overhead regression against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+    Time a cold start of the harness: `import src` plus resolving and validating the given task and agent configs, each
+    in a fresh interpreter. Run from the repository root:
+
+        python scripts/import_benchmark.py --task configs/tasks/example.yaml --agent configs/agents/do_nothing.yaml
+"""
+import sys
+import time
+import argparse
+import subprocess
+
+HEAVY_MODULES = ["torch", "pandas", "transformers", "docker", "nltk", "rouge", "jieba", "fastchat", "aiohttp"]
+
+CODE = """
+import sys, time
+start = time.time()
+import src
+from src.configs import YAMLConfig, LazyTask
+imported = time.time()
+for path in {tasks!r}:
+    LazyTask(path)
+for path in {agents!r}:
+    YAMLConfig.load_from_yaml(path).get_class()
+loaded = time.time()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(imported - start, loaded - imported, "|" + ",".join(heavy))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", nargs="*", default=[], help="Task config(s) to load")
+    parser.add_argument("--agent", nargs="*", default=[], help="Agent config(s) to resolve")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    code = CODE.format(tasks=args.task, agents=args.agent, heavy=HEAVY_MODULES)
+    totals, imports = [], []
+    heavy = ""
+    for _ in range(args.runs):
+        start = time.time()
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        totals.append(time.time() - start)
+        times, heavy = output.strip().splitlines()[-1].split("|")
+        imports.append(sum(float(value) for value in times.split()))
+    print(f"Process start to exit: min {min(totals):.3f}s, mean {sum(totals) / len(totals):.3f}s")
+    print(f"import src + load configs: min {min(imports):.3f}s, mean {sum(imports) / len(imports):.3f}s")
+    print(f"Heavy modules loaded: {heavy or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+    Throughput of continuous batching against fixed batches, with the same model and decode step. Requests have random
+    prompt and answer lengths; a fixed batch decodes until its longest answer is done before the next one starts.
+
+        PYTHONPATH="/path/to/STEPS_benchmark/" python -m batching_benchmark --requests 256 --batch_size 16
+        PYTHONPATH="/path/to/STEPS_benchmark/" python -m batching_benchmark --model_path /path/to/vicuna/7B --device cuda:0
+
+    Without `--model_path` a small randomly initialized LLaMA is decoded on the device, so only relative numbers matter.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from server.model_server import ContinuousScheduler
+from server.models.continuous import ContinuousBatchingEntry, Sequence
+
+
+class SyntheticEntry(ContinuousBatchingEntry):
+    """
+        Requests are (prompt length, answer length) pairs; answers never stop early.
+    """
+
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+        self.rng = random.Random(0)
+
+    def start(self, history, temperature: float) -> Sequence:
+        prompt_length, answer_length = history
+        vocab_size = self.model.config.vocab_size
+        input_ids = [self.rng.randrange(3, vocab_size) for _ in range(prompt_length)]
+        return Sequence(input_ids, temperature, answer_length, [])
+
+    def decode_output(self, output_ids) -> str:
+        return str(len(output_ids))
+
+
+def load_model(args):
+    if args.model_path:
+        dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+        return AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=dtype).to(args.device).eval()
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=32000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4,
+                         num_hidden_layers=args.layers, num_attention_heads=args.hidden_size // 64,
+                         max_position_embeddings=2048)
+    return LlamaForCausalLM(config).to(args.device).eval()
+
+
+def run(entry: SyntheticEntry, requests: list, arrivals: list, batch_size: int, continuous: bool) -> dict:
+    scheduler = ContinuousScheduler(entry, batch_size)
+    finished_at = {}
+    pending = 0
+    start = time.time()
+    while len(finished_at) < len(requests):
+        now = time.time() - start
+        admit = continuous or not scheduler.running
+        while admit and pending < len(requests) and arrivals[pending] <= now and scheduler.room() > 0:
+            scheduler.add([(requests[pending], 0.0, pending, False)])
+            pending += 1
+        if not scheduler.running and not scheduler.waiting:
+            time.sleep(max(0.0, arrivals[pending] - now))
+            continue
+        for index, _ in scheduler.step():
+            finished_at[index] = time.time() - start
+    wall_time = time.time() - start
+    latencies = [finished_at[index] - arrivals[index] for index in range(len(requests))]
+    return {
+        "wall_time": wall_time,
+        "tokens_per_sec": sum(answer for _, answer in requests) / wall_time,
+        "requests_per_sec": len(requests) / wall_time,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p95": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--prompt_length", type=int, nargs=2, default=[32, 512], help="Uniform range of prompt tokens")
+    parser.add_argument("--answer_length", type=float, nargs=2, default=[64, 1.0],
+                        help="Mean and sigma of the lognormal answer length in tokens")
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--arrival_rate", type=float, default=0, help="Requests per second, 0 to queue all at once")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    requests = [(
+        rng.randint(*args.prompt_length),
+        max(1, min(args.max_new_tokens, int(rng.lognormvariate(np.log(args.answer_length[0]), args.answer_length[1])))),
+    ) for _ in range(args.requests)]
+    arrivals = [0.0] * args.requests
+    if args.arrival_rate:
+        for index in range(1, args.requests):
+            arrivals[index] = arrivals[index - 1] + rng.expovariate(args.arrival_rate)
+    entry = SyntheticEntry(load_model(args))
+    run(entry, requests[:args.batch_size], arrivals[:args.batch_size], args.batch_size, True)  # warm up
+
+    print(f"{'scheduling':<12}{'batch':>7}{'wall s':>9}{'tokens/s':>10}{'requests/s':>12}{'p50 s':>8}{'p95 s':>8}")
+    for name, batch_size, continuous in [("sequential", 1, False), ("static", args.batch_size, False),
+                                         ("continuous", args.batch_size, True)]:
+        row = run(entry, requests, arrivals, batch_size, continuous)
+        print(f"{name:<12}{batch_size:>7}{row['wall_time']:>9.2f}{row['tokens_per_sec']:>10.1f}"
+              f"{row['requests_per_sec']:>12.2f}{row['latency_p50']:>8.2f}{row['latency_p95']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+    Same routes and JSON as model_api.py, served by one event loop: a pending call is a future instead of a thread
+    blocked on its own pipe, and all model processes send their results back over `ModelServer.responses`.
+    `/call` with `"stream": true` answers with server-sent events instead, see `stream_call`.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import multiprocessing as mp
+import threading
+from typing import Dict, Tuple, Union
+
+import torch.cuda
+from aiohttp import web
+
+from server.model_server import ModelServer, ModelServerError
+from utils import log as _log
+
+CLIENT_CHECK_INTERVAL = 1.0  # seconds a streamed call waits for output before checking that its client is still there
+
+
+def log(action: str, request: web.Request, data: dict, **kwargs):
+    _log({
+        "action": action,
+        "request": data,
+        "ip": request.remote,
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "additional": kwargs
+    })
+
+
+class ResponseRouter:
+    """
+        Reads the shared response queue in one thread and resolves the future of each request id on the event loop,
+        or for a streamed request puts each (output, done) on its queue.
+    """
+
+    def __init__(self, responses: mp.Queue, loop: asyncio.AbstractEventLoop) -> None:
+        self.responses = responses
+        self.loop = loop
+        self.ids = itertools.count()
+        self.pending: Dict[int, Union[asyncio.Future, asyncio.Queue]] = {}
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def create(self) -> Tuple[int, asyncio.Future]:
+        request_id = next(self.ids)
+        future = self.loop.create_future()
+        self.pending[request_id] = future
+        return request_id, future
+
+    def create_stream(self) -> Tuple[int, asyncio.Queue]:
+        request_id = next(self.ids)
+        queue = asyncio.Queue()
+        self.pending[request_id] = queue
+        return request_id, queue
+
+    def discard(self, request_id: int) -> None:
+        self.pending.pop(request_id, None)
+
+    def read(self) -> None:
+        while True:
+            replies = self.responses.get()
+            self.loop.call_soon_threadsafe(self.resolve, replies)
+
+    def resolve(self, replies) -> None:
+        for request_id, result, done in replies:
+            pending = self.pending.get(request_id)  # None if the client went away
+            if isinstance(pending, asyncio.Queue):
+                pending.put_nowait((result, done))
+            elif pending is not None and done and not pending.done():
+                pending.set_result(result)
+            if done:
+                self.pending.pop(request_id, None)
+
+
+@web.middleware
+async def validate(request: web.Request, handler):
+    if request.method != "POST":
+        raise web.HTTPMethodNotAllowed(request.method, ["POST"])
+
+    # check data structure
+    try:
+        data = dict(await request.json())
+    except (ValueError, TypeError):
+        raise web.HTTPBadRequest(text="Invalid JSON")
+    request["data"] = dict(data)
+    msg = data.pop("messages", None)
+    if msg:
+        for item in msg:
+            if "content" not in item or "role" not in item:
+                raise web.HTTPBadRequest(text="No Content or Role")
+            if item["role"] not in ["user", "assistant"]:
+                raise web.HTTPBadRequest(text="Role must be user or assistant")
+            if not isinstance(item["content"], str):
+                raise web.HTTPBadRequest(text="Content must be string")
+    tmp = data.pop("temperature", None)
+    if tmp:
+        if not isinstance(tmp, float):
+            raise web.HTTPBadRequest(text="Temperature must be float")
+    if not isinstance(data.pop("stream", False), bool):
+        raise web.HTTPBadRequest(text="Stream must be boolean")
+    return await handler(request)
+
+
+def check_model(model_server_name: str) -> None:
+    if model_server_name not in server.models:
+        raise web.HTTPForbidden(text="Invalid Model Name")
+
+
+async def activate(request: web.Request):
+    model_server_name = request.match_info["model_server_name"]
+    log("activate", request, request["data"], model_server_name=model_server_name)
+    check_model(model_server_name)
+    try:
+        if model_server_name not in server.model_devices:
+            await asyncio.get_running_loop().run_in_executor(None, server.add, model_server_name)
+        return web.json_response({"status": 0})
+    except ModelServerError as e:
+        return web.json_response({"status": -1, "message": str(e)})
+
+
+async def add(request: web.Request):
+    model_server_name = request.match_info["model_server_name"]
+    log("add", request, request["data"], model_server_name=model_server_name)
+    check_model(model_server_name)
+    try:
+        device = request["data"].get("device", None)
+        await asyncio.get_running_loop().run_in_executor(None, server.add, model_server_name, device)
+        return web.json_response({"status": 0})
+    except ModelServerError as e:
+        return web.json_response({"status": -1, "message": str(e)})
+
+
+async def remove(request: web.Request):
+    model_server_name = request.match_info["model_server_name"]
+    log(request.path.rsplit("/", 1)[-1], request, request["data"], model_server_name=model_server_name)
+    check_model(model_server_name)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, server.remove, model_server_name)
+        return web.json_response({"status": 0})
+    except ModelServerError as e:
+        return web.json_response({"status": -1, "message": str(e)})
+
+
+async def status(request: web.Request):
+    model_server_name = request.match_info["model_server_name"]
+    log("status", request, request["data"], model_server_name=model_server_name)
+    check_model(model_server_name)
+    try:
+        return web.json_response({"status": 0, "model_server_status": server.status(model_server_name)})
+    except ModelServerError as e:
+        return web.json_response({"status": -1, "message": str(e)})
+
+
+async def call(request: web.Request):
+    """
+        Same steps as `model_api.call`, except that the call is registered with a request id and awaits its future,
+        so an open request costs no thread.
+    """
+    model_server_name = request.match_info["model_server_name"]
+    data = request["data"]
+    log("call", request, data, model_server_name=model_server_name)
+    check_model(model_server_name)
+    try:
+        if not server.model_devices.get(model_server_name):
+            return web.json_response({"status": -1, "message": "model server %s is not active" % model_server_name})
+        if "messages" not in data:
+            raise web.HTTPForbidden(text="Not Messages")
+        if data.get("stream", False):
+            return await stream_call(request, model_server_name, data)
+        request_id, future = router.create()
+        try:
+            server.register(model_server_name, data["messages"], data.get("temperature", None), request_id)
+            ret = await future
+        finally:
+            router.discard(request_id)
+        log("call-result", request, data, result=ret)
+        return web.json_response({"status": 0, "result": ret})
+    except ModelServerError as e:
+        return web.json_response({"status": -1, "message": str(e)})
+
+
+def event(data: dict, name: str = None) -> bytes:
+    return (f"event: {name}\n" if name else "").encode() + b"data: " + json.dumps(data).encode() + b"\n\n"
+
+
+async def stream_call(request: web.Request, model_server_name: str, data: dict):
+    """
+        Answer a call with server-sent events: `{"text": ...}` with the output so far every few tokens (from entries
+        with continuous batching only), then one `result` event with the same JSON as a plain call. A client that
+        goes away cancels its request, which frees its batch slot.
+    """
+    request_id, queue = router.create_stream()
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    done = False
+    try:
+        server.register(model_server_name, data["messages"], data.get("temperature", None), request_id, stream=True)
+        await response.prepare(request)
+        while not done:
+            try:
+                ret, done = await asyncio.wait_for(queue.get(), CLIENT_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                if request.transport is None or request.transport.is_closing():
+                    raise ConnectionResetError("client went away")
+                continue
+            if not done:
+                await response.write(event({"text": ret}))
+        log("call-result", request, data, result=ret)
+        await response.write(event({"status": 0, "result": ret}, "result"))
+        await response.write_eof()
+    except (asyncio.CancelledError, ConnectionResetError) as e:
+        if not done:
+            server.cancel(model_server_name, request_id)
+            log("call-cancel", request, data)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+    finally:
+        router.discard(request_id)
+    return response
+
+
+async def global_status(request: web.Request):
+    log("global-status", request, request["data"])
+    return web.json_response({"status": 0, "info": server.status()})
+
+
+async def start_router(app: web.Application):
+    global router
+    router = ResponseRouter(server.responses, asyncio.get_running_loop())
+
+
+app = web.Application(middlewares=[validate], client_max_size=64 * 1024 ** 2)
+app.on_startup.append(start_router)
+app.add_routes([
+    web.post('/api/v1/{model_server_name}/activate', activate),
+    web.post('/api/v1/{model_server_name}/add', add),
+    web.post('/api/v1/{model_server_name}/deactivate', remove),
+    web.post('/api/v1/{model_server_name}/remove', remove),
+    web.post('/api/v1/{model_server_name}/status', status),
+    web.post('/api/v1/{model_server_name}/call', call),
+    web.post('/api/v1/', global_status),
+])
+server: ModelServer = None
+router: ResponseRouter = None
+
+if __name__ == '__main__':
+    mp.set_start_method("spawn")
+    with open("config.json") as f:
+        models = json.load(f)
+    server = ModelServer(models, ["cuda:%d" % i for i in range(torch.cuda.device_count())])
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--port", type=int, default=9999)
+    parse.add_argument("--model", type=str, default="")
+    parse.add_argument("--device", action="extend", nargs="+", type=str, default=[])
+    parse.add_argument("--backlog", type=int, default=4096, help="Pending connections the listening socket accepts")
+    args = parse.parse_args()
+    if args.model:
+        for d in args.device:
+            server.add(args.model, d)
+    web.run_app(app, host="0.0.0.0", port=args.port, backlog=args.backlog, access_log=None)
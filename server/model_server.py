@@ -1,8 +1,13 @@
+import bisect
 import multiprocessing as mp
+import time
 import traceback
-from typing import List, Dict, Any
+from collections import OrderedDict, deque
+from queue import Empty
+from typing import List, Dict, Any, Optional
 
 from .models import *
+from .models.continuous import PrefixCache
 
 
 class ModelServerError(ValueError):
@@ -10,73 +15,398 @@ class ModelServerError(ValueError):
 
 
 BATCH_SIZE = 8
+MAX_WAIT_MS = 10
+MAX_DELAY_MS = 1000
+LENGTH_BUCKETS = [128, 512, 2048]
+MAX_RUNNING = 16
+STREAM_INTERVAL = 2  # decode steps between two partial outputs of a streamed request
+CANCEL_TTL = 60  # seconds a model process remembers a cancelled request id that has not reached it
+MAX_CANCELLED = 4096
 
 
-def process(queue, entry_class: type(ModelServerEntry), params, device, expected_q_length: mp.Value, signal: mp.Event):
+def reply(results, responses: mp.Queue, done: bool = True):
+    """
+        Send each (conn, result). Results of request ids go on the shared response queue as (request id, result,
+        done), where `done` is False for the partial output of a streamed request.
+    """
+    replies = []
+    for conn, r in results:
+        if isinstance(conn, int):  # request id of a call waiting on the shared response queue
+            replies.append((conn, r, done))
+        else:
+            conn.send(r)
+    if replies:
+        responses.put(replies)
+
+
+def request_work(signal: mp.Event, wakeup: Optional[mp.Queue]) -> None:
+    """
+        Tell the batcher that a model can take a batch. It blocks on its input queue, so it is woken by a None there
+        unless the signal was set already.
+    """
+    if not signal.is_set():
+        signal.set()
+        if wakeup is not None:
+            wakeup.put(None)
+
+
+def drain(queue: Optional[mp.Queue]) -> set:
+    items = set()
+    while queue is not None:
+        try:
+            items.add(queue.get_nowait())
+        except Empty:
+            break
+    return items
+
+
+class CancelledRequests:
+    """
+        Ids of cancelled requests that have not reached this model process yet. Every process hears of every
+        cancellation, and most of those requests already finished or run elsewhere, so ids are forgotten after
+        `CANCEL_TTL` seconds and beyond `MAX_CANCELLED` ids. A request that arrives later just runs; the API drops
+        its reply.
+    """
+
+    def __init__(self, ttl: float = CANCEL_TTL, max_size: int = MAX_CANCELLED) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.ids = OrderedDict()  # request id -> time of the cancellation, oldest first
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, request_ids) -> None:
+        now = time.time()
+        for request_id in request_ids:
+            self.ids[request_id] = now
+            self.ids.move_to_end(request_id)
+        while self.ids and (len(self.ids) > self.max_size or next(iter(self.ids.values())) < now - self.ttl):
+            self.ids.popitem(last=False)
+
+    def pop(self, request_id) -> bool:
+        """
+            Whether the request was cancelled; it is forgotten either way.
+        """
+        return self.ids.pop(request_id, None) is not None
+
+
+class ContinuousScheduler:
+    """
+        Iteration-level batching for entries with `continuous_batching`: requests join the running batch between two
+        decode steps and leave it as soon as they finish, instead of waiting for the longest one of a fixed batch.
+    """
+
+    def __init__(self, model: ModelServerEntry, max_running: int) -> None:
+        self.model = model
+        self.max_running = max_running
+        self.waiting = deque()  # (history, temperature, conn, stream)
+        self.running = []  # (state, conn, stream)
+        self.cancelled = CancelledRequests()  # request ids cancelled before they got here
+        self.steps = 0
+
+    def room(self) -> int:
+        return self.max_running - len(self.running) - len(self.waiting)
+
+    def add(self, batch) -> None:
+        for request in batch:
+            if not self.cancelled.pop(request[2]):
+                self.waiting.append(request)
+
+    def cancel(self, request_ids: set) -> None:
+        """
+            Drop the requests of `request_ids`; a running one leaves the batch at the next step.
+        """
+        if not request_ids:
+            return
+        found = {request[2] for request in self.waiting} | {conn for _, conn, _ in self.running}
+        self.waiting = deque(request for request in self.waiting if request[2] not in request_ids)
+        self.running = [item for item in self.running if item[1] not in request_ids]
+        self.cancelled.add(request_ids - found)
+
+    def stream(self) -> list:
+        """
+            (conn, text so far) of the running streamed requests, every `STREAM_INTERVAL` steps.
+        """
+        if self.steps % STREAM_INTERVAL:
+            return []
+        partial = []
+        for state, conn, stream in self.running:
+            text = self.model.partial(state) if stream else None
+            if text is not None:
+                partial.append((conn, text))
+        return partial
+
+    def step(self) -> list:
+        """
+            Admit waiting requests up to `max_running` and decode one token; returns (conn, result) of those finished.
+        """
+        finished = []
+        while self.waiting and len(self.running) < self.max_running:
+            data, temperature, conn, stream = self.waiting.popleft()
+            try:
+                self.running.append((self.model.start(data, temperature), conn, stream))
+            except Exception:
+                traceback.print_exc()
+                finished.append((conn, None))
+        if not self.running:
+            return finished
+        self.steps += 1
+        try:
+            results = self.model.step([state for state, _, _ in self.running])
+        except Exception:
+            traceback.print_exc()
+            finished += [(conn, None) for _, conn, _ in self.running]
+            self.running = []
+            return finished
+        finished += [(conn, r) for (_, conn, _), r in zip(self.running, results) if r is not None]
+        self.running = [item for item, r in zip(self.running, results) if r is None]
+        return finished
+
+
+def process(queue, entry_class: type(ModelServerEntry), params, device, expected_q_length: mp.Value, signal: mp.Event,
+            responses: mp.Queue, max_running: int = 0, prefix_cache_mb: float = 0,
+            prefix_cache_stats: "PrefixCacheStats" = None, cancellations: mp.Queue = None, wakeup: mp.Queue = None):
     if type(params) is list:
         model = entry_class(*params)
     else:
         model = entry_class(**params)
     model.activate(device)
+    if prefix_cache_mb and model.continuous_batching:
+        model.prefix_cache = PrefixCache(int(prefix_cache_mb * 2 ** 20), prefix_cache_stats)
+    if max_running and model.continuous_batching:
+        return continuous_process(queue, model, max_running, signal, responses, cancellations, wakeup)
+    cancelled = CancelledRequests()
     while True:
         batch = queue.get()
         if queue.qsize() < expected_q_length.value:  # this number can be further optimized
-            signal.set()
-        data, temperature, conns = list(zip(*batch))
+            request_work(signal, wakeup)
+        cancelled.add(drain(cancellations))
+        if cancelled:
+            batch = [request for request in batch if not cancelled.pop(request[2])]
+            if not batch:
+                continue
+        data, temperature, conns, _ = list(zip(*batch))
         print("batch size", len(data))
         try:
             result = model.inference(data, temperature[0])
         except Exception:
             traceback.print_exc()
             result = [None] * len(data)
-        for conn, r in zip(conns, result):
-            conn.send(r)
+        reply(zip(conns, result), responses)
 
 
-def make_batch(queue_in: mp.Queue, queue_out: mp.Queue, batch_size: int, signal: mp.Event):
+def continuous_process(queue, model: ModelServerEntry, max_running: int, signal: mp.Event, responses: mp.Queue,
+                       cancellations: mp.Queue = None, wakeup: mp.Queue = None):
+    scheduler = ContinuousScheduler(model, max_running)
     while True:
-        signal.wait()  # avoid running too quickly and making too much small batches; instead, wait for models
-        signal.clear()
-        tmp = [queue_in.get()]  # block until not empty
-        while not queue_in.empty():
-            tmp.append(queue_in.get_nowait())
-        tmp.sort(key=lambda x: x[1])  # sort by temperature
-        t = tmp[0][1]
-        batch = []
-        for i in tmp:
-            if i[1] == t and len(batch) < batch_size:
-                batch.append(i)
-            else:
-                queue_out.put(batch)
-                batch = [i]
-                t = i[1]
-        queue_out.put(batch)
+        scheduler.cancel(drain(cancellations))
+        if not scheduler.running and not scheduler.waiting:
+            scheduler.add(queue.get())  # idle: block until there is work
+        while scheduler.room() > 0:
+            try:
+                scheduler.add(queue.get_nowait())
+            except Empty:
+                request_work(signal, wakeup)  # room for more, let the batcher hand over what it holds
+                break
+        reply(scheduler.step(), responses)
+        reply(scheduler.stream(), responses, done=False)
+
+
+def estimate_tokens(messages: list) -> int:
+    """
+        Prompt tokens from characters, as the batcher has no tokenizer: about 4 per token for ASCII, 1 otherwise.
+    """
+    tokens = 1
+    for item in messages:
+        ascii_chars = len(item["content"].encode("ascii", "ignore"))
+        tokens += ascii_chars // 4 + len(item["content"]) - ascii_chars
+    return tokens
+
+
+CLOSED_BY = ("full", "tokens", "timeout", "overdue")
+
+
+class BatchingStats:
+    """
+        Counters written by the batcher process and read by the API: batches per size and per closing reason, and the
+        share of padded prompt tokens that are real (padding efficiency, estimated).
+    """
+
+    def __init__(self, max_batch_size: int) -> None:
+        self.batch_sizes = mp.Array("l", max_batch_size + 1)
+        self.closed_by = mp.Array("l", len(CLOSED_BY))
+        self.efficiency = mp.Array("l", 10)  # batches per tenth of padding efficiency
+        self.tokens = mp.Array("d", 2)  # prompt tokens, padded prompt tokens
+
+    def record(self, size: int, reason: str, tokens: int, padded: int) -> None:
+        with self.batch_sizes.get_lock():
+            self.batch_sizes[size] += 1
+            self.closed_by[CLOSED_BY.index(reason)] += 1
+            self.efficiency[min(9, int(10 * tokens / padded))] += 1
+            self.tokens[0] += tokens
+            self.tokens[1] += padded
+
+    def get(self) -> Dict[str, Any]:
+        with self.batch_sizes.get_lock():
+            sizes = {size: count for size, count in enumerate(self.batch_sizes) if count}
+            closed_by = dict(zip(CLOSED_BY, self.closed_by))
+            efficiency = {
+                "%.1f-%.1f" % (i / 10, (i + 1) / 10): count for i, count in enumerate(self.efficiency) if count
+            }
+            tokens, padded = self.tokens
+        batches = sum(sizes.values())
+        return {
+            "batch_sizes": sizes,
+            "mean_batch_size": sum(size * count for size, count in sizes.items()) / batches if batches else 0,
+            "closed_by": closed_by,
+            "padding_efficiency": tokens / padded if padded else 1.0,
+            "padding_efficiency_histogram": efficiency,
+        }
+
+
+class PrefixCacheStats:
+    """
+        Counters written by the prefix caches of the model processes: prompts looked up, prompts that started from a
+        cached prefix, and prompt tokens that did not need a prefill.
+    """
+
+    def __init__(self) -> None:
+        self.counts = mp.Array("l", 4)  # lookups, hits, prompt tokens, prompt tokens found in the cache
+
+    def record(self, prompt_tokens: int, saved_tokens: int) -> None:
+        with self.counts.get_lock():
+            self.counts[0] += 1
+            self.counts[1] += bool(saved_tokens)
+            self.counts[2] += prompt_tokens
+            self.counts[3] += saved_tokens
+
+    def get(self) -> Dict[str, Any]:
+        with self.counts.get_lock():
+            lookups, hits, tokens, saved = self.counts
+        return {
+            "lookups": lookups,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "prompt_tokens": tokens,
+            "prefill_tokens_saved": saved,
+            "prefill_saved_ratio": saved / tokens if tokens else 0.0,
+        }
+
+
+class PendingBatch:
+    __slots__ = ("requests", "tokens", "longest", "opened")
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.tokens = 0
+        self.longest = 0
+        self.opened = time.monotonic()
+
+    def add(self, request, tokens: int) -> None:
+        self.requests.append(request)
+        self.tokens += tokens
+        self.longest = max(self.longest, tokens)
+
+    def padded(self, tokens: int = 0) -> int:
+        """
+            Prompt tokens of the batch once padded to its longest prompt, after adding a prompt of `tokens`.
+        """
+        return (len(self.requests) + bool(tokens)) * max(self.longest, tokens)
+
+
+def make_batch(queue_in: mp.Queue, queue_out: mp.Queue, max_batch_size: int, max_wait_ms: float,
+               max_batch_tokens: Optional[int], length_buckets: List[int], max_delay_ms: float, signal: mp.Event,
+               stats: BatchingStats):
+    """
+        Groups requests of one temperature and one prompt length bucket (split at `length_buckets` estimated tokens,
+        so short prompts are not padded to long ones) into batches of at most `max_batch_size` requests and
+        `max_batch_tokens` padded prompt tokens. A batch that is not full is sent once its first request has waited
+        `max_wait_ms` and a model asks for work through `signal`, so a busy model gets one large batch rather than
+        many small ones; after `max_delay_ms` it is sent anyway, so a rare bucket is not starved by busy ones. A None
+        on `queue_in` only wakes the batcher up, see `request_work`.
+    """
+    batches: Dict[tuple, PendingBatch] = {}  # (temperature, length bucket) -> batch
+
+    def send(key, reason):
+        batch = batches.pop(key)
+        queue_out.put(batch.requests)
+        stats.record(len(batch.requests), reason, batch.tokens, batch.padded())
+
+    while True:
+        timeout = None
+        if batches:
+            oldest = min(batch.opened for batch in batches.values())
+            now = time.monotonic()
+            timeout = max(0.0, oldest + max_wait_ms / 1000 - now)
+            if not timeout and not signal.is_set():  # due, but every model is busy: wait for one or until overdue
+                timeout = max(0.0, oldest + max_delay_ms / 1000 - now)
+        try:
+            item = queue_in.get(timeout=timeout)
+        except Empty:
+            item = None
+        if item is not None:
+            tokens = estimate_tokens(item[0])
+            key = (item[1], bisect.bisect_left(length_buckets, tokens))
+            if key in batches and max_batch_tokens and batches[key].padded(tokens) > max_batch_tokens:
+                send(key, "tokens")
+            if key not in batches:
+                batches[key] = PendingBatch()
+            batches[key].add(item, tokens)
+            if len(batches[key].requests) >= max_batch_size:
+                send(key, "full")
+        if batches:
+            now = time.monotonic()
+            ready = signal.is_set()
+            overdue = [key for key, batch in batches.items() if now - batch.opened >= max_delay_ms / 1000]
+            due = [key for key, batch in batches.items() if ready and now - batch.opened >= max_wait_ms / 1000]
+            for key in sorted(set(overdue + due), key=lambda key: batches[key].opened):  # oldest first
+                send(key, "overdue" if key in overdue else "timeout")
+            if due:
+                signal.clear()
 
 
 class ModelManager:
-    def __init__(self, entry_class: type[ModelServerEntry], config: dict) -> None:
+    def __init__(self, entry_class: type[ModelServerEntry], config: dict, responses: mp.Queue) -> None:
         self.params = config["params"]
+        # sequences decoded together by continuous batching, 0 for fixed batches of `batch_size`
+        self.max_running = config.get("max_running", MAX_RUNNING) if config.get("continuous_batching") else 0
+        # memory for the key/value of earlier prompts, per model process
+        self.prefix_cache_mb = config.get("prefix_cache_mb", 0)
+        self.prefix_cache_stats = PrefixCacheStats() if self.prefix_cache_mb else None
+        self.responses = responses
         self.entry_class = entry_class
         self.lock = mp.Lock()
         self.entities = {}
+        self.cancellations = {}  # device -> ids of the requests to drop, see `cancel`
         self.queue = mp.Queue()
         self.batched_queue = mp.Queue()
         self.batching_signal = mp.Event()
         self.batching_signal.set()
         self.entity_num = mp.Value("i", 0)
+        max_batch_size = config.get("max_batch_size", config.get("batch_size", BATCH_SIZE))
+        self.batching_stats = BatchingStats(max_batch_size)
         self.batcher = mp.Process(target=make_batch,
                                   args=(self.queue,
                                         self.batched_queue,
-                                        config.get("batch_size", BATCH_SIZE),
-                                        self.batching_signal))
+                                        max_batch_size,
+                                        config.get("max_wait_ms", MAX_WAIT_MS),
+                                        config.get("max_batch_tokens", None),
+                                        sorted(config.get("length_buckets", LENGTH_BUCKETS)),
+                                        config.get("max_delay_ms", MAX_DELAY_MS),
+                                        self.batching_signal,
+                                        self.batching_stats))
         self.batcher.start()
 
     def add(self, device: str):
+        cancellations = mp.Queue()
         p = mp.Process(target=process, args=(self.batched_queue, self.entry_class, self.params, device,
-                                             self.entity_num, self.batching_signal))
+                                             self.entity_num, self.batching_signal, self.responses,
+                                             self.max_running, self.prefix_cache_mb, self.prefix_cache_stats,
+                                             cancellations, self.queue))
         p.start()
         with self.lock:
             self.entities[device] = p
+            self.cancellations[device] = cancellations
             self.entity_num.value = len(self.entities)
 
     def remove(self, device: str = None):
@@ -84,14 +414,23 @@ class ModelManager:
         p.terminate()
         with self.lock:
             del self.entities[device]
+            del self.cancellations[device]
             self.entity_num.value = len(self.entities)
 
-    def enqueue(self, data: list[dict[str, str]], temperature: float, conn):
+    def cancel(self, request_id: int):
+        """
+            Tell every model process to drop the request; the one running it frees its batch slot.
+        """
+        with self.lock:
+            for cancellations in self.cancellations.values():
+                cancellations.put(request_id)
+
+    def enqueue(self, data: list[dict[str, str]], temperature: float, conn, stream: bool = False):
         if temperature is None:
             temperature = 0.7
-        self.queue.put((data, temperature, conn))
+        self.queue.put((data, temperature, conn, stream))
         if self.batched_queue.qsize() < len(self.entities):
-            self.batching_signal.set()
+            request_work(self.batching_signal, self.queue)  # the batcher may already hold this request, wake it too
         print(self.queue.qsize())
 
 
@@ -103,6 +442,7 @@ class ModelServer:
         self.model_devices: dict[str, list] = {}
         self.devices: dict[str, [str]] = {device: None for device in available_devices}
         self.managers = {}
+        self.responses = mp.Queue()  # (request id, result) batches from every model process, see `register`
 
     def find_device(self, model_name: str) -> str:
         with self.lock:
@@ -117,7 +457,8 @@ class ModelServer:
             if model_name not in self.managers:
                 if model_name not in self.models:
                     raise ModelServerError("Model not found")
-                manager = ModelManager(eval(self.models[model_name]["name"]), self.models[model_name])
+                manager = ModelManager(eval(self.models[model_name]["name"]), self.models[model_name],
+                                       self.responses)
                 self.managers[model_name] = manager
             else:
                 manager = self.managers[model_name]
@@ -143,10 +484,23 @@ class ModelServer:
     def status(self, model_name: str = None) -> Dict[str, Any]:
         if not model_name:
             return self.model_devices
-        return {model_name: self.model_devices[model_name]}
+        status = {model_name: self.model_devices[model_name]}
+        if model_name in self.managers:
+            status["batching"] = self.managers[model_name].batching_stats.get()
+            if self.managers[model_name].prefix_cache_stats is not None:
+                status["prefix_cache"] = self.managers[model_name].prefix_cache_stats.get()
+        return status
+
+    def register(self, model, messages, temperature, callback, stream=False):
+        """
+            `callback` is either a connection the result is sent to, or an int request id: the result is then put on
+            `self.responses` together with the id, so one reader can serve any number of pending calls. With `stream`,
+            a request id also gets the partial outputs of entries with continuous batching.
+        """
+        self.managers[model].enqueue(messages, temperature, callback, stream)
 
-    def register(self, model, messages, temperature, callback):
-        self.managers[model].enqueue(messages, temperature, callback)
+    def cancel(self, model, request_id: int):
+        self.managers[model].cancel(request_id)
 
     def stop(self):
         with self.lock:
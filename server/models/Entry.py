@@ -1,7 +1,9 @@
-from typing import List, Dict
+from typing import List, Dict, Any, Optional
 
 
 class ModelServerEntry:
+    continuous_batching = False  # implements `start` and `step`, see continuous.py
+
     def __init__(self, *args, **kwargs) -> None:
         pass
 
@@ -13,3 +15,13 @@ class ModelServerEntry:
 
     def inference(self, batch: List[List[Dict[str, str]]], temperature: float) -> List[str]:
         raise NotImplementedError
+
+    def start(self, history: List[Dict[str, str]], temperature: float) -> Any:
+        raise NotImplementedError
+
+    def step(self, states: List[Any]) -> List[Optional[str]]:
+        raise NotImplementedError
+
+    def partial(self, state: Any) -> Optional[str]:
+        # output so far of a state of `start`, for streamed requests; None if there is nothing to send yet
+        return None
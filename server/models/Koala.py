@@ -5,7 +5,8 @@ import sentencepiece as spm
 import torch
 from transformers import AutoModelForCausalLM, PreTrainedTokenizer
 
-from .Entry import ModelServerEntry
+from .Vicuna import generate_stream_batch
+from .continuous import ContinuousBatchingEntry, DecodeBatch
 
 
 class LLaMATokenizer(PreTrainedTokenizer):
@@ -166,7 +167,9 @@ class LLaMATokenizer(PreTrainedTokenizer):
         return len(token_ids_0 + eos + token_ids_1 + eos) * [0]
 
 
-class KoalaEntry(ModelServerEntry):
+class KoalaEntry(ContinuousBatchingEntry):
+    max_new_tokens = 1024
+
     def __init__(self, model_path) -> None:
         super().__init__()
         self.tokenizer = None
@@ -174,39 +177,6 @@ class KoalaEntry(ModelServerEntry):
         self.model = None
         self.model_path = model_path
 
-    def inference_koala(self, text, temperature):
-        inputs = self.prefix_tokenizer(
-            text,
-            padding='max_length',
-            truncation=True,
-            max_length=1024,
-            return_tensors='pt',
-        ).to(self.model.device)
-        input_tokens = inputs.input_ids
-        input_mask = inputs.attention_mask
-        input_tokens[:, 0] = self.tokenizer.bos_token_id
-        input_mask[:, 0] = 1
-
-        with torch.no_grad():
-            try:
-                output = self.model.generate(
-                    input_ids=input_tokens,
-                    attention_mask=input_mask,
-                    max_length=2048,
-                    do_sample=True,
-                    temperature=temperature
-                )[:, input_tokens.shape[1]:]
-            except Exception as e:
-                print(f"exception inference {e}")
-                return [""] * len(text)
-
-        output_text = []
-        for text in list(self.tokenizer.batch_decode(output)):
-            if self.tokenizer.eos_token in text:
-                text = text.split(self.tokenizer.eos_token, maxsplit=1)[0]
-            output_text.append(text)
-        return output_text
-
     def construct_prompt(self, batch: List[List[Dict[str, str]]]) -> List[str]:
         prompts = []
         for item in batch:
@@ -249,11 +219,38 @@ class KoalaEntry(ModelServerEntry):
         self.model = None
         self.tokenizer = None
         self.prefix_tokenizer = None
+        self.batch = DecodeBatch()
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
         torch.cuda.empty_cache()
         print("model and tokenizer cleared")
 
     def inference(self, batch: List[List[Dict[str, str]]], temperature=None) -> List[str]:
-        return self.inference_koala(self.construct_prompt(batch), temperature or 0.7)
+        params_list = [{
+            "input_ids": self.encode(h),
+            "temperature": temperature or 0.7,
+            "max_new_tokens": self.max_new_tokens,
+            "echo": False,
+        } for h in batch]
+        ret = [None] * len(batch)
+        try:
+            for ret in generate_stream_batch(self.model, self.tokenizer, params_list, self.model.device,
+                                             prefix_cache=self.prefix_cache):
+                pass
+        except Exception as e:
+            print(f"exception inference {e}")
+            return [""] * len(batch)
+        return [outputs["text"] if outputs else "" for outputs in ret]
+
+    def encode(self, history: List[Dict[str, str]]) -> List[int]:
+        input_ids = self.prefix_tokenizer(self.construct_prompt([history])[0]).input_ids
+        return [self.tokenizer.bos_token_id] + input_ids[-(self.context_len - self.max_new_tokens - 9):]
+
+    def decode_output(self, output_ids: List[int]) -> str:
+        return self.tokenizer.decode(output_ids).split(self.tokenizer.eos_token, maxsplit=1)[0]
+
+    def start(self, history: List[Dict[str, str]], temperature: float):
+        return super().start(history, temperature or 0.7)  # always sampled, as `inference`
 
 
 if __name__ == '__main__':
@@ -1,10 +1,11 @@
+import argparse
 import gc
-from typing import Iterable, List, Dict
+from typing import Iterable, List, Dict, Optional
 
 import torch
 from transformers import LogitsProcessorList, TemperatureLogitsWarper, AutoTokenizer, AutoModelForCausalLM
 
-from .Entry import ModelServerEntry
+from .continuous import ContinuousBatchingEntry, DecodeBatch, PrefixCache, Sequence
 
 
 def is_partial_stop(output, stop_str):
@@ -15,6 +16,21 @@ def is_partial_stop(output, stop_str):
     return False
 
 
+def find_stop_str(output: str, stop_str, rfind_start: int):
+    """Cut `output` at a stop string; returns the output, whether one was found and whether it ends with part of one."""
+    if isinstance(stop_str, str):
+        stop_str = [stop_str]
+    elif not isinstance(stop_str, Iterable):
+        raise ValueError("Invalid stop field type.")
+    for each_stop in stop_str:
+        pos = output.rfind(each_stop, rfind_start)
+        if pos != -1:
+            return output[:pos], True, False
+        if is_partial_stop(output, each_stop):
+            return output, False, True
+    return output, False, False
+
+
 def prepare_logits_processor(
         temperature: float
 ) -> LogitsProcessorList:
@@ -135,26 +151,8 @@ def generate_stream(
 
             partially_stopped = False
             if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+                output, found, partially_stopped = find_stop_str(output, stop_str, rfind_start)
+                stopped = stopped or found
 
             # prevent yielding partial stop sequence
             if not partially_stopped:
@@ -193,7 +191,71 @@ def generate_stream(
     del past_key_values, out
 
 
-class VicunaEntry(ModelServerEntry):
+def generate_stream_batch(model, tokenizer, params_list: List[dict], device, context_len=2048, stream_interval=2,
+                          prefix_cache: Optional[PrefixCache] = None):
+    """
+        `generate_stream` for several prompts at once. The prompts are left-padded into one batch with an attention
+        mask and a shared key/value cache; each row stops on its own stop tokens and strings, and finished rows leave
+        the batch. Yields the latest output of every row (None before its first) in the format of `generate_stream`.
+        A param may give `input_ids` instead of `prompt`. Decoder-only models only. With a `prefix_cache`, prompts
+        start from the cached key/value of their longest known prefix, and finished rows are cached in turn.
+    """
+    assert not model.config.is_encoder_decoder, "batched decoding needs a decoder-only model"
+    if not params_list:
+        return
+    sequences = []
+    for params in params_list:
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        input_ids = params.get("input_ids") or tokenizer(params["prompt"]).input_ids
+        stop_token_ids = list(params.get("stop_token_ids", None) or []) + [tokenizer.eos_token_id]
+        sequences.append(Sequence(input_ids[-(context_len - max_new_tokens - 8):],
+                                  float(params.get("temperature", 1.0)), max_new_tokens, stop_token_ids))
+    rows = {id(sequence): row for row, sequence in enumerate(sequences)}
+    outputs = [None] * len(sequences)
+
+    batch = DecodeBatch.prefill(model, sequences, prefix_cache)
+    while batch.sequences:
+        finished = set()
+        for sequence in batch.sequences:
+            row, params = rows[id(sequence)], params_list[rows[id(sequence)]]
+            i = len(sequence.output_ids) - 1
+            stopped = sequence.output_ids[-1] in sequence.stop_token_ids
+            if not (i % stream_interval == 0 or i == sequence.max_new_tokens - 1 or stopped):
+                continue
+            if params.get("echo", True):
+                tmp_output_ids, rfind_start = sequence.input_ids + sequence.output_ids, len(params.get("prompt", ""))
+            else:
+                tmp_output_ids, rfind_start = sequence.output_ids, 0
+            output = tokenizer.decode(tmp_output_ids, skip_special_tokens=True, spaces_between_special_tokens=False)
+            partially_stopped = False
+            if params.get("stop", None):
+                output, found, partially_stopped = find_stop_str(output, params["stop"], rfind_start)
+                stopped = stopped or found
+            if i == sequence.max_new_tokens - 1:
+                finish_reason = "length"
+            elif stopped:
+                finish_reason = "stop"
+            else:
+                finish_reason = None
+            if not partially_stopped or finish_reason:
+                outputs[row] = {
+                    "text": output,
+                    "usage": {
+                        "prompt_tokens": len(sequence.input_ids),
+                        "completion_tokens": i,
+                        "total_tokens": len(sequence.input_ids) + i,
+                    },
+                    "finish_reason": finish_reason,
+                }
+            if finish_reason:
+                finished.add(id(sequence))
+        yield list(outputs)
+        batch.keep([sequence for sequence in batch.sequences if id(sequence) not in finished], prefix_cache)
+        if batch.sequences:
+            batch.decode(model)
+
+
+class VicunaEntry(ContinuousBatchingEntry):
     def __init__(self, model_path: str):
         super().__init__()
         self.model = None
@@ -201,22 +263,22 @@ class VicunaEntry(ModelServerEntry):
         self.model_path = model_path
 
     def inference(self, batch: List[List[Dict[str, str]]], temperature: float = 0.7) -> List[str]:
-        ret = []
-        for h in batch:
-            gen_params = {
-                "model": self.model_path,
-                "prompt": self.get_prompt([h]),
-                "temperature": temperature,
-                "stop": None,
-                "stop_token_ids": None,
-                "echo": False,
-            }
-            output_stream = generate_stream(self.model, self.tokenizer, gen_params, self.model.device)
-            output_text = ""
-            for outputs in output_stream:
-                output_text = outputs["text"]
-            ret.append(output_text)
-        return ret
+        params_list = [{
+            "model": self.model_path,
+            "prompt": self.get_prompt([h]),
+            "temperature": temperature,
+            "stop": None,
+            "stop_token_ids": None,
+            "echo": False,
+        } for h in batch]
+        ret = [None] * len(batch)
+        for ret in generate_stream_batch(self.model, self.tokenizer, params_list, self.model.device,
+                                         prefix_cache=self.prefix_cache):
+            pass
+        return [outputs["text"] if outputs else "" for outputs in ret]
+
+    def encode(self, history: List[Dict[str, str]]) -> List[int]:
+        return self.tokenizer(self.get_prompt([history])).input_ids
 
     def get_prompt(self, batch: List[List[Dict[str, str]]]) -> str:
         seps = [" ", "</s>"]
@@ -251,12 +313,97 @@ class VicunaEntry(ModelServerEntry):
         del self.tokenizer
         self.model = None
         self.tokenizer = None
+        self.batch = DecodeBatch()
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
         gc.collect()
         torch.cuda.empty_cache()
         print("model and tokenizer cleared")
 
 
+class CharTokenizer:
+    """
+        Tokenizer of `check_batched_decoding`: one id per character, 0-2 reserved.
+    """
+
+    eos_token_id = 2
+
+    def __call__(self, text: str):
+        return argparse.Namespace(input_ids=[1] + [3 + ord(c) % 253 for c in text])
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = False, **kwargs) -> str:
+        return "".join(chr(i - 3) for i in ids if i > 2 or not skip_special_tokens)
+
+
+def check_batched_decoding(rows: int = 8, max_new_tokens: int = 48) -> None:
+    """
+        Greedy outputs of `generate_stream_batch` must equal those of `generate_stream` row by row. Uses a tiny random
+        LLaMA on the CPU, with prompts of different lengths; some rows stop on a string or a token of their answer.
+        Then the same for a second turn of each prompt, which mostly comes from a prefix cache.
+    """
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                         num_attention_heads=4, max_position_embeddings=2048)).eval()
+    tokenizer = CharTokenizer()
+
+    def sequential(params_list):
+        results = []
+        for params in params_list:
+            outputs = None
+            for outputs in generate_stream(model, tokenizer, dict(params), "cpu"):
+                pass
+            results.append(outputs)
+        return results
+
+    params_list = [{
+        "prompt": "USER: " + "question %d " % row * (1 + 5 * row) + "ASSISTANT:",
+        "temperature": 0.0,
+        "max_new_tokens": max_new_tokens - 4 * row,
+        "echo": row % 2 == 0,
+    } for row in range(rows)]
+    for params, outputs in zip(params_list, sequential(params_list)):
+        answer = outputs["text"][len(params["prompt"]):] if params["echo"] else outputs["text"]
+        if len(params["prompt"]) % 3 == 0:
+            params["stop"] = answer[len(answer) // 2:len(answer) // 2 + 2]
+        elif len(params["prompt"]) % 3 == 1:
+            params["stop_token_ids"] = tokenizer(answer[len(answer) // 3]).input_ids[1:]
+    expected = sequential(params_list)
+    outputs = None
+    for outputs in generate_stream_batch(model, tokenizer, params_list, "cpu"):
+        pass
+    for row, (want, got) in enumerate(zip(expected, outputs)):
+        assert want["text"] == got["text"], f"row {row}: {want['text']!r} != {got['text']!r}"
+        assert want["finish_reason"] == got["finish_reason"], f"row {row}: finish reason"
+    stopped = sum(want["finish_reason"] == "stop" for want in expected)
+    print(f"batched decoding matches sequential decoding on {rows} rows, {stopped} of them stopped early")
+
+    from server.model_server import PrefixCacheStats  # absolute, so `python -m models.Vicuna` works too
+    stats = PrefixCacheStats()
+    cache = PrefixCache(2 ** 30, stats)
+    for outputs in generate_stream_batch(model, tokenizer, params_list, "cpu", prefix_cache=cache):
+        pass
+    next_turns = [{
+        "prompt": params["prompt"] + (got["text"][len(params["prompt"]):] if params["echo"] else got["text"])
+                  + " USER: and then? ASSISTANT:",
+        "temperature": 0.0,
+        "max_new_tokens": max_new_tokens,
+        "echo": False,
+    } for params, got in zip(params_list, outputs)]
+    expected = sequential(next_turns)
+    for outputs in generate_stream_batch(model, tokenizer, next_turns, "cpu", prefix_cache=cache):
+        pass
+    for row, (want, got) in enumerate(zip(expected, outputs)):
+        assert want["text"] == got["text"], f"turn 2, row {row}: {want['text']!r} != {got['text']!r}"
+    print(f"second turns match with a prefix cache: {stats.get()}")
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="Compare batched and sequential decoding on the CPU")
+    if parser.parse_args().check:
+        check_batched_decoding()
+        exit()
     entry = VicunaEntry("/workspace/xuyifan/checkpoints/vicuna/7B")
     entry.activate("cuda:1")
     print(entry.inference([[
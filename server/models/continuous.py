@@ -0,0 +1,303 @@
+import itertools
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+import torch
+
+from .Entry import ModelServerEntry
+
+
+def pad_left(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if tensor.shape[dim] >= length:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class Sequence:
+    """
+        One request being decoded: its prompt ids, sampling settings and the ids generated so far.
+    """
+
+    __slots__ = ("input_ids", "temperature", "max_new_tokens", "stop_token_ids", "output_ids")
+
+    def __init__(self, input_ids: List[int], temperature: float, max_new_tokens: int, stop_token_ids: List[int]):
+        self.input_ids = input_ids
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.stop_token_ids = stop_token_ids
+        self.output_ids: List[int] = []
+
+    @property
+    def finished(self) -> bool:
+        return len(self.output_ids) >= self.max_new_tokens or (
+                bool(self.output_ids) and self.output_ids[-1] in self.stop_token_ids)
+
+
+def sample(logits: torch.Tensor, temperatures: List[float]) -> List[int]:
+    """
+        One token per row of `logits`, greedy for a temperature below 1e-5 as in `generate_stream`.
+    """
+    logits = logits.float()
+    tokens = torch.argmax(logits, dim=-1)
+    temperature = torch.as_tensor(temperatures, device=logits.device, dtype=logits.dtype)
+    greedy = temperature < 1e-5
+    if not bool(greedy.all()):
+        probs = torch.softmax(logits / temperature.clamp(min=1e-5)[:, None], dim=-1)
+        tokens = torch.where(greedy, tokens, torch.multinomial(probs, num_samples=1)[:, 0])
+    return tokens.tolist()
+
+
+class PrefixCache:
+    """
+        Key/value caches of sequences that left a batch, so a prompt that starts like an earlier prompt and its answer
+        (the next turn of a conversation) only prefills the rest. Entries are found by the hashes of their token
+        prefixes at every `block_size` tokens and evicted least recently used beyond `budget` bytes.
+    """
+
+    block_size = 16
+
+    def __init__(self, budget: int, stats=None) -> None:
+        self.budget = budget
+        self.stats = stats  # `record(prompt_tokens, saved_tokens)` per lookup, see `model_server.PrefixCacheStats`
+        self.entries: OrderedDict = OrderedDict()  # entry id -> (tokens, past, prefix hashes, bytes)
+        self.index: Dict[int, set] = {}  # prefix hash -> ids of the entries that start with this prefix
+        self.ids = itertools.count()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def hashes(self, tokens) -> List[int]:
+        """
+            Hashes of `tokens[:block_size]`, `tokens[:2 * block_size]`, ..., each chained to the one before.
+        """
+        ret, h = [], 0
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(tokens[start:start + self.block_size])))
+            ret.append(h)
+        return ret
+
+    def lookup(self, tokens: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+            Longest cached prefix of `tokens` that leaves at least one token to prefill: its length and, if not 0, its
+            per layer (key, value), each [1, heads, length, head_dim].
+        """
+        length, past = 0, None
+        hashes = self.hashes(tokens[:-1])
+        for block in reversed(range(len(hashes))):
+            n = (block + 1) * self.block_size
+            for entry_id in self.index.get(hashes[block], ()):
+                entry_tokens, entry_past = self.entries[entry_id][:2]
+                if list(entry_tokens[:n]) == tokens[:n]:  # not a hash collision
+                    self.entries.move_to_end(entry_id)
+                    length, past = n, tuple((key[:, :, :n], value[:, :, :n]) for key, value in entry_past)
+                    break
+            if past is not None:
+                break
+        if self.stats is not None:
+            self.stats.record(len(tokens), length)
+        return length, past
+
+    def insert(self, tokens: List[int], past: tuple) -> None:
+        """
+            Cache the whole blocks of `tokens`, whose per layer (key, value) are `past`. Entries this one extends, as
+            the previous turn of its conversation, are dropped.
+        """
+        length = len(tokens) // self.block_size * self.block_size
+        if not length:
+            return
+        tokens = tuple(tokens[:length])
+        past = tuple((key[:, :, :length].contiguous(), value[:, :, :length].contiguous()) for key, value in past)
+        size = sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in past)
+        if size > self.budget:
+            return
+        hashes = self.hashes(tokens)
+        for block, h in enumerate(hashes):
+            for entry_id in list(self.index.get(h, ())):
+                entry_tokens = self.entries[entry_id][0]
+                if len(entry_tokens) == (block + 1) * self.block_size and entry_tokens == tokens[:len(entry_tokens)]:
+                    self.remove(entry_id)
+        entry_id = next(self.ids)
+        self.entries[entry_id] = (tokens, past, hashes, size)
+        for h in hashes:
+            self.index.setdefault(h, set()).add(entry_id)
+        self.size += size
+        while self.size > self.budget:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_id: int) -> None:
+        _, _, hashes, size = self.entries.pop(entry_id)
+        for h in hashes:
+            ids = self.index[h]
+            ids.discard(entry_id)
+            if not ids:
+                del self.index[h]
+        self.size -= size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.index.clear()
+        self.size = 0
+
+
+class DecodeBatch:
+    """
+        Key/value caches of the running sequences of a decoder-only model, left-padded to one length and masked, so that
+        a sequence can join after its prefill, or leave, between any two decode steps.
+    """
+
+    def __init__(self) -> None:
+        self.sequences: List[Sequence] = []
+        self.past = None  # per layer (key, value), each [batch, heads, length, head_dim]
+        self.mask: Optional[torch.Tensor] = None  # [batch, length], 0 on padding
+        self.positions: Optional[torch.Tensor] = None  # [batch], position id of the next token
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @classmethod
+    @torch.no_grad()
+    def prefill(cls, model, sequences: List[Sequence], cache: Optional[PrefixCache] = None) -> "DecodeBatch":
+        """
+            Run the prompts of `sequences` left-padded through `model` in one pass and sample their first tokens. With a
+            `cache`, each prompt starts from the cached key/value of its longest known prefix and only the rest is run.
+        """
+        cached = [cache.lookup(sequence.input_ids) if cache is not None else (0, None) for sequence in sequences]
+        prompts = [sequence.input_ids[prefix:] for sequence, (prefix, _) in zip(sequences, cached)]
+        length = max(len(prompt) for prompt in prompts)
+        padding = [length - len(prompt) for prompt in prompts]
+        input_ids = torch.as_tensor([[0] * pad + prompt for pad, prompt in zip(padding, prompts)], device=model.device)
+        mask = torch.as_tensor([[0] * pad + [1] * (length - pad) for pad in padding], device=model.device)
+        position_ids = (mask.cumsum(dim=1) - 1).clamp(min=0)
+        past = None
+        longest = max(prefix for prefix, _ in cached)
+        if longest:
+            like = next(prefix_past for _, prefix_past in cached if prefix_past is not None)
+            empty = tuple((key[:, :, :0], value[:, :, :0]) for key, value in like)
+            past = tuple(
+                tuple(torch.cat([pad_left((prefix_past or empty)[layer][i], longest, 2) for _, prefix_past in cached])
+                      for i in range(2))
+                for layer in range(len(like))
+            )
+            prefixes = [prefix for prefix, _ in cached]
+            mask = torch.cat([torch.as_tensor([[0] * (longest - prefix) + [1] * prefix for prefix in prefixes],
+                                              device=model.device), mask], dim=1)
+            position_ids = position_ids + torch.as_tensor(prefixes, device=model.device)[:, None]
+        out = model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids, past_key_values=past,
+                    use_cache=True)
+        batch = cls()
+        batch.sequences = list(sequences)
+        batch.past, batch.mask, batch.positions = out.past_key_values, mask, mask.sum(dim=1)
+        tokens = sample(out.logits[:, -1, :], [sequence.temperature for sequence in sequences])
+        for sequence, token in zip(sequences, tokens):
+            sequence.output_ids.append(token)
+        return batch
+
+    @torch.no_grad()
+    def decode(self, model) -> None:
+        """
+            Feed every row its last token and sample the next one.
+        """
+        input_ids = torch.as_tensor([[sequence.output_ids[-1]] for sequence in self.sequences],
+                                    device=self.mask.device)
+        mask = torch.cat([self.mask, self.mask.new_ones(len(self), 1)], dim=1)
+        out = model(input_ids=input_ids, attention_mask=mask, position_ids=self.positions[:, None],
+                    past_key_values=self.past, use_cache=True)
+        self.past, self.mask, self.positions = out.past_key_values, mask, self.positions + 1
+        tokens = sample(out.logits[:, -1, :], [sequence.temperature for sequence in self.sequences])
+        for sequence, token in zip(self.sequences, tokens):
+            sequence.output_ids.append(token)
+
+    def keep(self, sequences: List[Sequence], cache: Optional[PrefixCache] = None) -> None:
+        """
+            Drop the rows of the sequences not in `sequences`, and the padding columns no remaining row needs. The
+            key/value of a dropped row go to `cache`, if any.
+        """
+        wanted = set(map(id, sequences))
+        rows = [row for row, sequence in enumerate(self.sequences) if id(sequence) in wanted]
+        if len(rows) == len(self.sequences):
+            return
+        if cache is not None:
+            for row, sequence in enumerate(self.sequences):
+                if id(sequence) not in wanted:
+                    columns = self.mask[row].nonzero()[:, 0]
+                    cache.insert(sequence.input_ids + sequence.output_ids[:-1],
+                                 tuple((key[row:row + 1, :, columns], value[row:row + 1, :, columns])
+                                       for key, value in self.past))
+        if not rows:
+            self.__init__()
+            return
+        index = torch.as_tensor(rows, device=self.mask.device)
+        self.sequences = [self.sequences[row] for row in rows]
+        self.mask = self.mask[index]
+        self.positions = self.positions[index]
+        start = int(self.mask.any(dim=0).nonzero()[0])
+        self.mask = self.mask[:, start:]
+        self.past = tuple((key[index, :, start:], value[index, :, start:]) for key, value in self.past)
+
+    def extend(self, other: "DecodeBatch") -> None:
+        """
+            Append the rows of `other`, padding the shorter of the two caches.
+        """
+        if not self.sequences:
+            self.__dict__.update(other.__dict__)
+            return
+        length = max(self.mask.shape[1], other.mask.shape[1])
+        self.past = tuple(
+            (torch.cat([pad_left(key, length, 2), pad_left(other_key, length, 2)], dim=0),
+             torch.cat([pad_left(value, length, 2), pad_left(other_value, length, 2)], dim=0))
+            for (key, value), (other_key, other_value) in zip(self.past, other.past)
+        )
+        self.mask = torch.cat([pad_left(self.mask, length, 1), pad_left(other.mask, length, 1)], dim=0)
+        self.positions = torch.cat([self.positions, other.positions])
+        self.sequences = self.sequences + other.sequences
+
+
+class ContinuousBatchingEntry(ModelServerEntry):
+    """
+        Iteration-level batching for decoder-only entries with a `self.model`: implement `encode` (and maybe
+        `decode_output`) and the server's scheduler calls `start` for each request and `step` for all running ones.
+    """
+
+    continuous_batching = True
+    context_len = 2048
+    max_new_tokens = 256
+    prefix_cache: Optional[PrefixCache] = None  # set by the server with `prefix_cache_mb` in config
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.batch = DecodeBatch()
+
+    def encode(self, history: List[Dict[str, str]]) -> List[int]:
+        raise NotImplementedError
+
+    def decode_output(self, output_ids: List[int]) -> str:
+        return self.tokenizer.decode(output_ids, skip_special_tokens=True, spaces_between_special_tokens=False)
+
+    def partial(self, sequence: Sequence) -> Optional[str]:
+        return self.decode_output(sequence.output_ids)
+
+    def stop_token_ids(self) -> List[int]:
+        return [self.tokenizer.eos_token_id]
+
+    def start(self, history: List[Dict[str, str]], temperature: float) -> Sequence:
+        max_src_len = self.context_len - self.max_new_tokens - 8
+        return Sequence(self.encode(history)[-max_src_len:], temperature, self.max_new_tokens, self.stop_token_ids())
+
+    def step(self, sequences: List[Sequence]) -> List[Optional[str]]:
+        """
+            Decode one more token for every running sequence, prefilling those new to the batch; returns the text of
+            the ones that finished and None for the others. Sequences no longer passed are dropped from the batch.
+        """
+        self.batch.keep(sequences, self.prefix_cache)
+        running = set(map(id, self.batch.sequences))
+        if self.batch.sequences:
+            self.batch.decode(self.model)
+        joined = [sequence for sequence in sequences if id(sequence) not in running]
+        if joined:
+            self.batch.extend(DecodeBatch.prefill(self.model, joined, self.prefix_cache))
+        results = [self.decode_output(sequence.output_ids) if sequence.finished else None for sequence in sequences]
+        self.batch.keep([sequence for sequence in sequences if not sequence.finished], self.prefix_cache)
+        return results
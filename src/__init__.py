@@ -2,4 +2,3 @@ from .agent import Agent, Session
 from .task import *
 from .configs import *
 from .utils import print_rank_0, JsonEncoder
-from .agents import *
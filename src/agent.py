@@ -8,19 +8,27 @@ import math
 import random
 import datetime
 import argparse
+import asyncio
+import functools
 import requests
 
 
 from dataclass_wizard import YAMLWizard
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Any, Callable
+
+from .timing import track_call, set_response, timed, atimed
+from .retry import RetryPolicy
+from .stop import stop_scope
 
 
 class Session:
-    def __init__(self, model_inference, history=None) -> None:
+    def __init__(self, model_inference, history=None, amodel_inference=None, stop=None) -> None:
         self.history: list[dict] = history or []
         self.model_inference = model_inference
+        self.amodel_inference = amodel_inference
+        self.stop = stop  # name of a predicate in src.stop.STOP_PREDICATES, checked by streaming agents
 
     def inject(self, message: dict) -> None:
         assert isinstance(message, dict)
@@ -30,7 +38,7 @@ class Session:
         assert message["role"] in ["user", "agent"]
         self.history.append(message)
 
-    def action(self, extend_messages) -> str:
+    def _extend(self, extend_messages) -> List[dict]:
         extend = []
         if extend_messages:
             if isinstance(extend_messages, list):
@@ -39,22 +47,145 @@ class Session:
                 extend.append(extend_messages)
             else:
                 raise Exception("Invalid extend_messages")
-        result = self.model_inference(self.history + extend)
+        return extend
+
+    def action(self, extend_messages=None) -> str:
+        extend = self._extend(extend_messages)
+        with track_call(self.history + extend) as record, stop_scope(self.stop):
+            result = self.model_inference(self.history + extend)
+            set_response(record, result)
+        self.history.extend(extend)
+        self.history.append({"role": "agent", "content": result})
+        return result
+
+    async def aaction(self, extend_messages=None) -> str:
+        if not self.amodel_inference:
+            raise NotImplementedError("This session is not bound to an async agent")
+        extend = self._extend(extend_messages)
+        with track_call(self.history + extend) as record, stop_scope(self.stop):
+            result = await self.amodel_inference(self.history + extend)
+            set_response(record, result)
         self.history.extend(extend)
         self.history.append({"role": "agent", "content": result})
         return result
 
 
+class AgentLayer:
+    """
+        Wraps `Agent.inference`. Layers are configured in the agent YAML and the first one is the outermost.
+    """
+
+    name = "layer"
+
+    def __call__(self, agent: "Agent", history: List[dict], inference: Callable[[List[dict]], str]) -> str:
+        return inference(history)
+
+    async def acall(self, agent: "Agent", history: List[dict], ainference: Callable) -> str:
+        return await ainference(history)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {}
+
+
 class Agent:
+    supports_stop = False  # True if `inference` ends generation early when the session's stop predicate matches
+    harness_options = ("cache", "single_flight", "hedge", "rate_limit", "retry")  # popped by `Agent.__init__`
+
     def __init__(self, **configs) -> None:
         self.name = configs.pop("name", None)
         self.src = configs.pop("src", None)
+        self.layers: List[AgentLayer] = []
+        self.retry = RetryPolicy(**(configs.pop("retry", None) or {}))
+        cache = configs.pop("cache", None)
+        if cache:
+            from .cache import ResponseCache
+            self.layers.append(ResponseCache(**(cache if isinstance(cache, dict) else {})))
+        single_flight = configs.pop("single_flight", "auto")
+        if single_flight:
+            from .single_flight import SingleFlight
+            self.layers.append(SingleFlight(single_flight))
+        hedge = configs.pop("hedge", None)
+        if hedge:
+            from .hedging import Hedging
+            self.layers.append(Hedging(**(hedge if isinstance(hedge, dict) else {})))  # above rate_limit
+        rate_limit = configs.pop("rate_limit", None)
+        if rate_limit:
+            from .rate_limit import RateLimiter
+            self.layers.append(RateLimiter(self, **rate_limit))
         for key in configs:
             print(f"Warning: Unknown argument '{key}' for the agent.")
         pass
 
-    def create_session(self) -> Session:
-        return Session(self.inference)
+    @property
+    def is_async(self) -> bool:
+        """
+            True if the agent implements `ainference` natively, so that `Task.predict_all` can drive it from an event loop.
+        """
+        return type(self).ainference is not Agent.ainference
+
+    @property
+    def supports_batching(self) -> bool:
+        """
+            True if the agent sends several conversations in one request, see `batch_inference`.
+        """
+        return type(self).batch_inference is not Agent.batch_inference
+
+    def create_session(self, inference: Callable = None, ainference: Callable = None, stop: str = None) -> Session:
+        """
+            `inference`/`ainference` replace the innermost model call below the layers, e.g. with a micro-batcher.
+        """
+        return Session(functools.partial(self.call, inference=inference),
+                       amodel_inference=functools.partial(self.acall, ainference=ainference) if self.is_async else None,
+                       stop=stop)
+
+    def call(self, history: List[dict], inference: Callable = None) -> str:
+        inference = timed(inference or self.inference)
+        for layer in reversed(self.layers):
+            inference = functools.partial(layer, self, inference=inference)
+        return inference(history)
+
+    async def acall(self, history: List[dict], ainference: Callable = None) -> str:
+        ainference = atimed(ainference or self.ainference)
+        for layer in reversed(self.layers):
+            ainference = functools.partial(layer.acall, self, ainference=ainference)
+        return await ainference(history)
+
+    def get_generation_params(self) -> Dict[str, Any]:
+        """
+            Fields that determine the generated text, i.e. every JSON-serializable attribute except the bookkeeping ones.
+        """
+        params = {}
+        for key, value in self.__dict__.items():
+            if key.startswith("_") or key in ("name", "src", "layers", "retry", "read_timeout"):
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            params[key] = value
+        return params
+
+    def is_deterministic(self) -> bool:
+        params = self.get_generation_params()
+        for scope in (params, params.get("parameters"), params.get("api_args")):
+            if isinstance(scope, dict) and "temperature" in scope:
+                return not scope["temperature"]
+        return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {layer.name: layer.get_stats() for layer in self.layers}
 
     def inference(self, history: List[dict]) -> str:
         raise NotImplementedError
+
+    async def ainference(self, history: List[dict]) -> str:
+        raise NotImplementedError
+
+    def batch_inference(self, histories: List[List[dict]]) -> List[str]:
+        """
+            One response per history, in order. Agents whose endpoint accepts several conversations override this.
+        """
+        return [self.inference(history) for history in histories]
+
+    async def abatch_inference(self, histories: List[List[dict]]) -> List[str]:
+        return list(await asyncio.gather(*[self.ainference(history) for history in histories]))
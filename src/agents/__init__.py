@@ -1,22 +1,29 @@
-from .local_agent import LocalAgent
-from .do_nothing_agent import DoNothingAgent
-# from .fastchat_client import FastChatAgent
-# from .llm_agent import *
-try:
-    from .local import *
-except:
-    print("> [Warning] Local agent not available")
-try:
-    from .fastchat_client import FastChatAgent
-except:
-    print("> [Warning] FastChat agent not available")
-try:
-    from .api_agents import *
-except:
-    print("> [Warning] API agents not available")
-try:
-    from .http_agent import HTTPAgent
-except:
-    print("> [Warning] HTTP agent not available")
+import importlib
 
-# from .chatglm import *
\ No newline at end of file
+# Agent classes are imported on first access (see src/tasks/__init__.py), so that e.g. a DoNothingAgent run does not
+# need fastchat or aiohttp.
+_AGENT_MODULES = {
+    "LocalAgent": ".local_agent",
+    "StreamingLocalAgent": ".local_agent",
+    "DoNothingAgent": ".do_nothing_agent",
+    "FastChatAgent": ".fastchat_client",
+    "BalancedAgent": ".balanced_agent",
+    "APIAgent": ".api_agents",
+    "APIAgent_claude": ".api_agents",
+    "APIAgent_completion": ".api_agents",
+    "OpenAIChatCompletion": ".api_agents",
+    "OpenAICompletion": ".api_agents",
+    "Claude": ".api_agents",
+}
+
+
+def __getattr__(name):
+    if name not in _AGENT_MODULES:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(importlib.import_module(_AGENT_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_AGENT_MODULES))
@@ -1,9 +1,22 @@
-try:
-    from .openai_agents import OpenAIChatCompletion, OpenAICompletion
-except:
-    print("> [Warning] OpenAI Agents are not available")
-try:
-    from .claude_agents import Claude
-except:
-    print("> [Warning] OpenAI Agents are not available")
-from .api import APIAgent, APIAgent_claude, APIAgent_completion
\ No newline at end of file
+import importlib
+
+_AGENT_MODULES = {
+    "OpenAIChatCompletion": ".openai_agents",
+    "OpenAICompletion": ".openai_agents",
+    "Claude": ".claude_agents",
+    "APIAgent": ".api",
+    "APIAgent_claude": ".api",
+    "APIAgent_completion": ".api",
+}
+
+
+def __getattr__(name):
+    if name not in _AGENT_MODULES:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(importlib.import_module(_AGENT_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_AGENT_MODULES))
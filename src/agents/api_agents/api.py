@@ -1,4 +1,6 @@
+import importlib.util
 import argparse
+import asyncio
 import json
 import time
 import requests
@@ -6,14 +8,21 @@ import os, json, sys, time, re, math, random, datetime, argparse, requests
 from typing import List, Dict, Any
 
 from src.agent import Agent
+from src.retry import RetryableError, check_response, endpoint_of
+from src.transport import get_transport
 
 # import TimeoutException
 from requests.exceptions import Timeout, ConnectionError
 
+# aiohttp is imported by the transport on the first async request, so that sync runs do not load it
+HAS_AIOHTTP = importlib.util.find_spec("aiohttp") is not None
+
 
 class APIAgent(Agent):
     """This agent is a test agent, which does nothing. (return empty string for each action)"""
 
+    url = 'http://180.184.39.132:9629/call_api'
+
     def __init__(self, model_name, temperature=0, max_new_tokens=32, top_p=0, **kwargs) -> None:
         self.model_name = model_name
         self.temperature = temperature
@@ -22,33 +31,57 @@ class APIAgent(Agent):
         print(self.max_new_tokens)
         super().__init__(**kwargs)
 
+    @property
+    def is_async(self) -> bool:
+        return HAS_AIOHTTP
+
+    def build_message(self, histories: List[List[dict]]) -> dict:
+        return {
+            "messages": [[{
+                "role": "user" if (item["role"] == "user") else "assistant",
+                "content": item["content"],
+            } for item in history] for history in histories],
+            "model": self.model_name,
+        }
+
     def inference(self, history: List[dict]) -> str:
-        for _ in range(3):
-            try:
-                time.sleep(0.2)
-                url = 'http://180.184.39.132:9629/call_api'
-                headers = {'Content-Type': 'application/json; charset=utf-8'}
-                msg = {
-                    "messages": [[{
-                        "role": "user" if (item["role"] == "user") else "assistant",
-                        "content": item["content"],
-                    } for item in history]],
-                    "model": self.model_name,
-                }
-                resp = requests.post(url, headers=headers, data=json.dumps(msg), timeout=120)
-                if resp.status_code != 200:
-                    raise Exception(f"Invalid status code {resp.status_code}:\n\n{resp.text}")
-                try:
-                    return resp.json()["data"][0]
-                except:
-                    raise Exception(f"Invalid response:\n\n{resp.text}")
-            except:
-                pass
-        return ""
+        return self.batch_inference([history])[0]
+
+    async def ainference(self, history: List[dict]) -> str:
+        return (await self.abatch_inference([history]))[0]
+
+    def parse_batch(self, text: str, histories: List[List[dict]]) -> List[str]:
+        try:
+            data = json.loads(text)["data"]
+            assert len(data) == len(histories)
+            return data
+        except:
+            raise RetryableError(f"Invalid response:\n\n{text}")
+
+    def batch_inference(self, histories: List[List[dict]]) -> List[str]:
+        def request():
+            headers = {'Content-Type': 'application/json; charset=utf-8'}
+            msg = self.build_message(histories)
+            resp = get_transport().post(self.url, headers=headers, data=json.dumps(msg))
+            check_response(resp.status_code, resp.text, resp.headers)
+            return self.parse_batch(resp.text, histories)
+        return self.retry.call(endpoint_of(self.url), request)
+
+    async def abatch_inference(self, histories: List[List[dict]]) -> List[str]:
+        async def request():
+            headers = {'Content-Type': 'application/json; charset=utf-8'}
+            msg = self.build_message(histories)
+            async with get_transport().async_session().post(self.url, headers=headers, data=json.dumps(msg)) as resp:
+                text = await resp.text()
+            check_response(resp.status, text, resp.headers)
+            return self.parse_batch(text, histories)
+        return await self.retry.acall(endpoint_of(self.url), request)
 
 class APIAgent_claude(Agent):
     """This agent is a test agent, which does nothing. (return empty string for each action)"""
 
+    url = 'http://40.74.217.35:10015/api/chat'
+
     def __init__(self, model_name, temperature=0, max_new_tokens=32, top_p=0, **kwargs) -> None:
         self.model_name = model_name
         self.temperature = temperature
@@ -58,34 +91,29 @@ class APIAgent_claude(Agent):
         super().__init__(**kwargs)
 
     def inference(self, history: List[dict]) -> str:
-        for _ in range(3):
+        def request():
+            headers = {"content-type": "application/json; charset=utf-8"}
+            msg = {
+                "messages": [{
+                    "role": "user" if (item["role"] == "user") else "assistant",
+                    "content": item["content"],
+                } for item in history],
+                "model": self.model_name,
+                "max tokens": 256,
+            }
+            resp = get_transport().post(self.url, headers=headers, data=json.dumps(msg))
+            check_response(resp.status_code, resp.text, resp.headers)
             try:
-                time.sleep(0.2)
-                url = 'http://40.74.217.35:10015/api/chat'
-                headers = {"content-type": "application/json; charset=utf-8"}
-                msg = {
-                    "messages": [{
-                        "role": "user" if (item["role"] == "user") else "assistant",
-                        "content": item["content"],
-                    } for item in history],
-                    "model": self.model_name,
-                    "max tokens": 256,
-                }
-                resp = requests.post(url, headers=headers, data=json.dumps(msg), timeout=120)
-
-                if resp.status_code != 200:
-                    raise Exception(f"Invalid status code {resp.status_code}:\n\n{resp.text}")
-                try:
-                    return eval(resp.text)
-                except:
-                    raise Exception(f"Invalid response:\n\n{resp.text}")
+                return eval(resp.text)
             except:
-                pass
-        return ""
+                raise RetryableError(f"Invalid response:\n\n{resp.text}")
+        return self.retry.call(endpoint_of(self.url), request)
 
 class APIAgent_completion(Agent):
     """This agent is a test agent, which does nothing. (return empty string for each action)"""
 
+    url = 'http://40.74.217.35:10015/api/completion'
+
     def __init__(self, model_name, temperature=0, max_new_tokens=32, top_p=0, **kwargs) -> None:
         self.model_name = model_name
         self.temperature = temperature
@@ -95,23 +123,14 @@ class APIAgent_completion(Agent):
         super().__init__(**kwargs)
 
     def inference(self, history: List[dict]) -> str:
-        for _ in range(3):
-            try:
-                time.sleep(0.2)
-                url = 'http://40.74.217.35:10015/api/completion'
-                headers = {"content-type": "application/json; charset=utf-8"}
-                msg = {
-                    "prompt": history[-1]["content"],
-                    "model": self.model_name,
-                    "max_tokens": 256,
-                }
-                resp = requests.post(url, headers=headers, data=json.dumps(msg), timeout=120)
-                if resp.status_code != 200:
-                    raise Exception(f"Invalid status code {resp.status_code}:\n\n{resp.text}")
-                try:
-                    return resp.text
-                except:
-                    raise Exception(f"Invalid response:\n\n{resp.text}")
-            except:
-                pass
-        return ""
+        def request():
+            headers = {"content-type": "application/json; charset=utf-8"}
+            msg = {
+                "prompt": history[-1]["content"],
+                "model": self.model_name,
+                "max_tokens": 256,
+            }
+            resp = get_transport().post(self.url, headers=headers, data=json.dumps(msg))
+            check_response(resp.status_code, resp.text, resp.headers)
+            return resp.text
+        return self.retry.call(endpoint_of(self.url), request)
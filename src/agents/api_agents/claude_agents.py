@@ -1,4 +1,3 @@
-import anthropic
 from src.agent import Agent
 import os
 import json
@@ -14,8 +13,20 @@ from typing import List, Callable
 import dataclasses
 from copy import deepcopy
 
+from src.retry import RetryableError, check_response, endpoint_of
+from src.transport import get_transport
+
+HUMAN_PROMPT = "\n\nHuman:"
+AI_PROMPT = "\n\nAssistant:"
+
 
 class Claude(Agent):
+    """
+        Text completions API, called through the shared transport and retry policy like the other API agents.
+    """
+
+    url = "https://api.anthropic.com/v1/complete"
+
     def __init__(self, api_args=None, **config):
         if not api_args:
             api_args = {}
@@ -28,20 +39,24 @@ class Claude(Agent):
             raise ValueError("Claude model is required, please assign api_args.model.")
         self.api_args = api_args
         if not self.api_args.get("stop_sequences"):
-            self.api_args["stop_sequences"] = [anthropic.HUMAN_PROMPT]
-        super.__init__(**config)
+            self.api_args["stop_sequences"] = [HUMAN_PROMPT]
+        super().__init__(**config)
 
     def inference(self, history: List[dict]) -> str:
         prompt = ""
         for message in history:
             if message["role"] == "user":
-                prompt += anthropic.HUMAN_PROMPT + message["content"]
+                prompt += HUMAN_PROMPT + message["content"]
             else:
-                prompt += anthropic.AI_PROMPT + message["content"]
-        prompt += anthropic.AI_PROMPT
-        c = anthropic.Client(self.key)
-        resp = c.completion(
-            prompt=prompt,
-            **self.api_args
-        )
-        return resp
\ No newline at end of file
+                prompt += AI_PROMPT + message["content"]
+        prompt += AI_PROMPT
+
+        def request():
+            headers = {"Content-Type": "application/json", "x-api-key": self.key, "anthropic-version": "2023-06-01"}
+            resp = get_transport().post(self.url, headers=headers, data=json.dumps({"prompt": prompt, **self.api_args}))
+            check_response(resp.status_code, resp.text, resp.headers)
+            try:
+                return resp.json()["completion"]
+            except (ValueError, KeyError):
+                raise RetryableError(f"Invalid response:\n\n{resp.text}")
+        return self.retry.call(endpoint_of(self.url), request)
@@ -1,4 +1,3 @@
-import openai
 from src.agent import Agent
 import os
 import json
@@ -14,49 +13,56 @@ from typing import List, Callable
 import dataclasses
 from copy import deepcopy
 
+from src.retry import RetryableError, check_response, endpoint_of
+from src.transport import get_transport
+
+
+class OpenAIAgent(Agent):
+    """
+        Posts `api_args` (minus the key, and `timeout` in seconds) to `url` through the shared transport and retry
+        policy, so OpenAI calls get the same pooling, backoff and circuit breaker as the other API agents.
+    """
+
+    url = "https://api.openai.com/v1"
 
-class OpenAIChatCompletion(Agent):
     def __init__(self, api_args=None, **config):
         if not api_args:
             api_args = {}
         api_args = deepcopy(api_args)
-        api_args["key"] = api_args.pop("key", None) or os.getenv('OPENAI_API_KEY')
+        self.key = api_args.pop("key", None) or os.getenv('OPENAI_API_KEY')
         api_args["model"] = api_args.pop("model", None)
-        if not api_args["key"]:
+        if not self.key:
             raise ValueError("OpenAI API key is required, please assign api_args.key or set OPENAI_API_KEY environment variable.")
         if not api_args["model"]:
             raise ValueError("OpenAI model is required, please assign api_args.model.")
+        self.timeout = api_args.pop("timeout", None)
         self.api_args = api_args
-        super.__init__(**config)
+        super().__init__(**config)
+
+    def post(self, path: str, body: dict) -> dict:
+        def request():
+            headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.key}"}
+            resp = get_transport().post(self.url + path, headers=headers, data=json.dumps({**body, **self.api_args}),
+                                        timeout=self.timeout)
+            check_response(resp.status_code, resp.text, resp.headers)
+            try:
+                return resp.json()["choices"][0]
+            except (ValueError, KeyError, IndexError):
+                raise RetryableError(f"Invalid response:\n\n{resp.text}")
+        return self.retry.call(endpoint_of(self.url), request)
+
 
+class OpenAIChatCompletion(OpenAIAgent):
     def inference(self, history: List[dict]) -> str:
         history = json.loads(json.dumps(history))
         for h in history:
             if h['role'] == 'agent':
                 h['role'] = 'assistant'
 
-        resp = openai.ChatCompletion.create(
-            messages=history,
-            **self.api_args
-        )
+        return self.post("/chat/completions", {"messages": history})["message"]["content"]
 
-        return resp.json()["choices"][0]["message"]["content"]
-
-
-class OpenAICompletion(Agent):
-    def __init__(self, api_args=None, **config):
-        if not api_args:
-            api_args = {}
-        api_args = deepcopy(api_args)
-        api_args["key"] = api_args.pop("key", None) or os.getenv('OPENAI_API_KEY')
-        api_args["model"] = api_args.pop("model", None)
-        if not api_args["key"]:
-            raise ValueError("OpenAI API key is required, please assign api_args.key or set OPENAI_API_KEY environment variable.")
-        if not api_args["model"]:
-            raise ValueError("OpenAI model is required, please assign api_args.model.")
-        self.api_args = api_args
-        super.__init__(**config)
 
+class OpenAICompletion(OpenAIAgent):
     def inference(self, history: List[dict]) -> str:
         prompt = ""
         for h in history:
@@ -65,9 +71,4 @@ class OpenAICompletion(Agent):
             prompt += f"{role}: {content}\n\n"
         prompt += 'Assistant: '
 
-        resp = openai.Completion.create(
-            prompt=prompt,
-            **self.api_args
-        )
-
-        return resp.json()["choices"][0]["text"]
\ No newline at end of file
+        return self.post("/completions", {"prompt": prompt})["text"]
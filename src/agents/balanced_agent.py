@@ -0,0 +1,196 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import List, Dict, Any, Callable
+
+from src.agent import Agent
+from src.retry import retryable_errors, CircuitOpenError, get_breaker, endpoint_of
+from src.timing import record_retry, percentiles
+
+SELECTIONS = ("least_outstanding", "power_of_two")
+
+
+class BalancedAgent(Agent):
+    """
+        Spreads model calls over several identical endpoints, each served by its own copy of `agent`:
+
+            module: "src.agents.BalancedAgent"
+            parameters:
+                name: "vicuna-13b-fleet"
+                agent:
+                    module: "src.agents.FastChatAgent"
+                    parameters: {model_name: "vicuna-13b", max_new_tokens: 512}
+                endpoint_key: "worker_address"  # parameter of `agent` that is set to each endpoint
+                endpoints: ["http://10.0.0.1:21002", "http://10.0.0.2:21002"]
+                selection: "least_outstanding"  # or "power_of_two"
+                eject_after: 3  # consecutive failures before an endpoint is ejected
+                eject_for: 30  # seconds until an ejected endpoint gets a probe request
+
+        Ejection is the endpoint's circuit breaker (src/retry.py). A call that fails is retried at once on another
+        endpoint, and after a backoff once every endpoint has failed it, up to `retry.max_attempts` times in total.
+        Every attempt goes through the hooks of `retry`, so that a rate limit charges each retry.
+    """
+
+    def __init__(self, agent: dict, endpoints: List[str], endpoint_key: str = "url",
+                 selection: str = "least_outstanding", eject_after: int = 3, eject_for: float = 30.0, **kwargs) -> None:
+        super().__init__(**kwargs)
+        from src.configs import YAMLConfig
+        assert endpoints, "BalancedAgent needs at least one endpoint"
+        assert selection in SELECTIONS, f"selection must be one of {', '.join(SELECTIONS)}"
+        self.agent = agent
+        self.endpoints = list(endpoints)
+        self.endpoint_key = endpoint_key
+        self.selection = selection
+        self.agents: List[Agent] = []
+        for endpoint in self.endpoints:
+            # layers run once, in the balancer
+            parameters = {
+                key: value for key, value in agent.get("parameters", {}).items() if key not in self.harness_options
+            }
+            parameters.update({
+                endpoint_key: endpoint,
+                "single_flight": False,
+                "retry": {"max_attempts": 1, "failure_threshold": eject_after, "reset_timeout": eject_for},
+            })
+            self.agents.append(YAMLConfig(agent["module"], parameters).create())
+        self.breakers = [get_breaker(endpoint_of(endpoint), eject_after, eject_for) for endpoint in self.endpoints]
+        self.lock = threading.Lock()
+        self.outstanding = [0] * len(self.endpoints)
+        self.requests = [0] * len(self.endpoints)
+        self.failures = [0] * len(self.endpoints)
+        self.latencies = [deque(maxlen=10000) for _ in self.endpoints]
+
+    @property
+    def is_async(self) -> bool:
+        return all(agent.is_async for agent in self.agents)
+
+    @property
+    def supports_batching(self) -> bool:
+        return all(agent.supports_batching for agent in self.agents)
+
+    @property
+    def supports_stop(self) -> bool:
+        return all(agent.supports_stop for agent in self.agents)
+
+    def get_generation_params(self) -> Dict[str, Any]:
+        """
+            The endpoints serve the same model, so they share cache entries.
+        """
+        params = self.agents[0].get_generation_params()
+        params.pop(self.endpoint_key, None)
+        return params
+
+    def is_deterministic(self) -> bool:
+        return self.agents[0].is_deterministic()
+
+    def select(self, tried: set) -> int:
+        with self.lock:
+            candidates = [index for index in range(len(self.agents))
+                          if index not in tried and self.breakers[index].available()]
+            if not candidates:  # all ejected: the chosen agent raises CircuitOpenError with the wait until its probe
+                candidates = [index for index in range(len(self.agents)) if index not in tried]
+            if self.selection == "power_of_two" and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            least = min(self.outstanding[index] for index in candidates)
+            index = random.choice([index for index in candidates if self.outstanding[index] == least])
+            self.outstanding[index] += 1
+            return index
+
+    def finish(self, index: int, latency: float = None, failed: bool = False, sent: bool = True) -> None:
+        with self.lock:
+            self.outstanding[index] -= 1
+            self.requests[index] += sent
+            if failed:
+                self.failures[index] += 1
+            if latency is not None:
+                self.latencies[index].append(latency)
+
+    def next_attempt(self, attempt: int, index: int, tried: set, error: Exception):
+        """
+            Account for a failed attempt; returns the delay before the next one, or None if there is none.
+        """
+        rejected = isinstance(error, CircuitOpenError)
+        self.finish(index, failed=not rejected, sent=not rejected)
+        if attempt + 1 == self.retry.max_attempts:
+            return None
+        tried.add(index)
+        if len(tried) < len(self.agents):
+            return 0.0  # fail over to another endpoint right away
+        tried.clear()
+        return self.retry.delay(attempt, getattr(error, "retry_after", None))
+
+    def dispatch(self, call: Callable[[Agent], Any]):
+        tried = set()
+        for attempt in range(self.retry.max_attempts):
+            if attempt:
+                record_retry()
+            index = self.select(tried)
+            wait = self.retry.before_attempt(endpoint_of(self.endpoints[index]), attempt)  # e.g. the rate limit
+            if wait:
+                time.sleep(wait)
+            start = time.time()
+            try:
+                result = call(self.agents[index])
+            except retryable_errors() as e:
+                delay = self.next_attempt(attempt, index, tried, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.finish(index)
+                raise
+            self.finish(index, time.time() - start)
+            return result
+
+    async def adispatch(self, call: Callable[[Agent], Any]):
+        tried = set()
+        for attempt in range(self.retry.max_attempts):
+            if attempt:
+                record_retry()
+            index = self.select(tried)
+            wait = self.retry.before_attempt(endpoint_of(self.endpoints[index]), attempt)
+            if wait:
+                await asyncio.sleep(wait)
+            start = time.time()
+            try:
+                result = await call(self.agents[index])
+            except retryable_errors() as e:
+                delay = self.next_attempt(attempt, index, tried, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.finish(index)
+                raise
+            self.finish(index, time.time() - start)
+            return result
+
+    def inference(self, history: List[dict]) -> str:
+        return self.dispatch(lambda agent: agent.inference(history))
+
+    async def ainference(self, history: List[dict]) -> str:
+        return await self.adispatch(lambda agent: agent.ainference(history))
+
+    def batch_inference(self, histories: List[List[dict]]) -> List[str]:
+        return self.dispatch(lambda agent: agent.batch_inference(histories))
+
+    async def abatch_inference(self, histories: List[List[dict]]) -> List[str]:
+        return await self.adispatch(lambda agent: agent.abatch_inference(histories))
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        with self.lock:
+            stats["endpoints"] = {
+                endpoint: {
+                    "requests": self.requests[index],
+                    "failures": self.failures[index],
+                    "outstanding": self.outstanding[index],
+                    "state": self.breakers[index].state,
+                    "latency": percentiles(list(self.latencies[index])),
+                } for index, endpoint in enumerate(self.endpoints)
+            }
+        return stats
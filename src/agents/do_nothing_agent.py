@@ -1,4 +1,6 @@
 from src.agent import Agent
+from src.retry import RetryableError
+from src.sink import read_lines
 from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Type, TypeVar
 import os
 import json
@@ -9,17 +11,138 @@ import math
 import random
 import datetime
 import argparse
+import asyncio
+import itertools
+import threading
 import requests
 
+DISTRIBUTIONS = ("constant", "uniform", "normal", "lognormal", "exponential")
+
+
+def sample(config: Union[None, float, Dict[str, Any]], rng: random.Random) -> float:
+    """
+        Draw from `config`: a number (constant), or {distribution, mean, std, min, max}. For `lognormal`, `mean` and
+        `std` are those of the distribution itself, not of its logarithm.
+    """
+    if not isinstance(config, dict):
+        return float(config or 0)
+    distribution = config.get("distribution", "constant")
+    mean, std = config.get("mean", 0.0), config.get("std", 0.0)
+    if distribution == "constant":
+        value = mean
+    elif distribution == "uniform":
+        value = rng.uniform(config.get("min", 0.0), config.get("max", 2 * mean))
+    elif distribution == "normal":
+        value = rng.gauss(mean, std)
+    elif distribution == "lognormal":
+        sigma = math.sqrt(math.log(1 + (std / mean) ** 2)) if mean else 0.0
+        value = rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean else 0.0
+    elif distribution == "exponential":
+        value = rng.expovariate(1 / mean) if mean else 0.0
+    else:
+        raise ValueError(f"Unknown distribution '{distribution}', expected one of {', '.join(DISTRIBUTIONS)}")
+    return min(max(value, config.get("min", 0.0)), config.get("max", math.inf))
+
+
+class Replay:
+    """
+        Outputs of a recorded generation.jsonl, matched on the prompt or else handed out in order.
+    """
+
+    __slots__ = ("path", "recorded", "outputs")  # no __dict__, so configs.json does not dump the whole file
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.recorded: Dict[str, str] = {}
+        outputs = []
+        for line in read_lines(path):
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(item.get("output"), str):
+                continue
+            outputs.append(item["output"])
+            if isinstance(item.get("input"), str):
+                self.recorded[item["input"]] = item["output"]
+        if not outputs:
+            raise ValueError(f"No string outputs to replay in '{path}'")
+        self.outputs = itertools.cycle(outputs)
+
+    def __str__(self) -> str:
+        return f"Replay({self.path})"
+
+    def next(self, prompt: Optional[str]) -> str:
+        return self.recorded.get(prompt) or next(self.outputs)
+
 
 class DoNothingAgent(Agent):
-    """This agent is a test agent, which does nothing. (return empty string for each action)"""
+    """
+        This agent is a test agent, which does nothing (returns "AAAAA" for each action). It can also simulate a model
+        server, to measure the harness without a GPU:
 
-    def __init__(self, sleep=None, **kwargs) -> None:
+            sleep: 0.5  # fixed latency, or
+            latency: {distribution: lognormal, mean: 2.0, std: 1.5, max: 30}  # seconds per call
+            error_rate: 0.02  # share of calls that fail with a retryable error
+            response_length: {distribution: normal, mean: 400, std: 200}  # characters per response
+            replay: "outputs/<run>/<task>/generation.jsonl"  # answer with recorded outputs
+            seed: 0
+
+        A batch of histories costs one latency draw.
+    """
+
+    def __init__(self, sleep=None, latency=None, error_rate=0.0, response_length=None, replay=None, seed=None,
+                 **kwargs) -> None:
         super().__init__(**kwargs)
         self.sleep = sleep
+        self.latency = latency
+        self.error_rate = error_rate
+        self.response_length = response_length
+        self.replay = replay
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._replay = Replay(replay) if replay else None
 
-    def inference(self, history: List[dict]) -> str:
-        if self.sleep:
-            time.sleep(self.sleep)
+    def draw(self) -> Tuple[float, bool]:
+        """
+            Latency of the next call, and whether it fails.
+        """
+        with self._lock:
+            latency = sample(self.latency, self._rng) if self.latency is not None else (self.sleep or 0)
+            return latency, self._rng.random() < self.error_rate
+
+    def respond(self, history: List[dict]) -> str:
+        with self._lock:
+            if self._replay is not None:
+                prompt = next((item["content"] for item in reversed(history) if item["role"] == "user"), None)
+                return self._replay.next(prompt)
+            if self.response_length is not None:
+                return "A" * int(sample(self.response_length, self._rng))
         return "AAAAA"
+
+    def inference(self, history: List[dict]) -> str:
+        return self.batch_inference([history])[0]
+
+    async def ainference(self, history: List[dict]) -> str:
+        return (await self.abatch_inference([history]))[0]
+
+    def batch_inference(self, histories: List[List[dict]]) -> List[str]:
+        def request():
+            latency, failed = self.draw()
+            if latency:
+                time.sleep(latency)  # one round-trip for the whole batch
+            if failed:
+                raise RetryableError("Simulated error")
+            return [self.respond(history) for history in histories]
+        return self.retry.call("do-nothing", request) if self.error_rate else request()
+
+    async def abatch_inference(self, histories: List[List[dict]]) -> List[str]:
+        async def request():
+            latency, failed = self.draw()
+            if latency:
+                await asyncio.sleep(latency)
+            if failed:
+                raise RetryableError("Simulated error")
+            return [self.respond(history) for history in histories]
+        return await self.retry.acall("do-nothing", request) if self.error_rate else await request()
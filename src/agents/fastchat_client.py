@@ -7,6 +7,10 @@ from typing import List, Dict, Any
 
 from fastchat.model.model_adapter import get_conversation_template
 from src.agent import Agent
+from src.retry import check_response, endpoint_of
+from src.stop import stop_at
+from src.timing import record_early_stop
+from src.transport import get_transport
 
 # import TimeoutException
 from requests.exceptions import Timeout, ConnectionError
@@ -15,6 +19,8 @@ from requests.exceptions import Timeout, ConnectionError
 class FastChatAgent(Agent):
     """This agent is a test agent, which does nothing. (return empty string for each action)"""
 
+    supports_stop = True
+
     def __init__(self, model_name, controller_address=None, worker_address=None, temperature=0, max_new_tokens=32, top_p=0, **kwargs) -> None:
         if controller_address is None and worker_address is None:
             raise ValueError("Either controller_address or worker_address must be specified.")
@@ -69,25 +75,20 @@ class FastChatAgent(Agent):
             "echo": False,
             "top_p": self.top_p,
         }
-        for _ in range(3):
-            try:
-                response = requests.post(
-                    controller_addr + "/worker_generate_stream",
-                    headers=headers,
-                    json=gen_params,
-                    stream=True,
-                    timeout=120,
-                )
+        url = worker_addr + "/worker_generate_stream"
+
+        def request():
+            with get_transport().post(url, headers=headers, json=gen_params, stream=True) as response:
+                # closing the response returns its connection to the pool
+                if response.status_code != 200:
+                    check_response(response.status_code, response.text, response.headers)
                 text = ""
                 for line in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
                     if line:
                         text = json.loads(line)["text"]
+                        end = stop_at(text)
+                        if end is not None:  # leaving the with-block closes the stream and stops the worker
+                            record_early_stop()
+                            return text[:end]
                 return text
-            # if timeout or connection error, retry
-            except Timeout: 
-                print("Timeout, retrying...")
-            except ConnectionError:
-                print("Connection error, retrying...")
-            time.sleep(5)
-        else:
-            raise Exception("Timeout after 3 retries.")
+        return self.retry.call(endpoint_of(url), request)
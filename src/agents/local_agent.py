@@ -1,21 +1,148 @@
+import importlib.util
 from src.agent import Agent
+from src.retry import RetryableError, check_response, endpoint_of
+from src.stop import stop_at
+from src.timing import record_early_stop, record_first_token
+from src.transport import get_transport
+from src.utils import SSEClient
 import os, json, sys, time, re, math, random, datetime, argparse, requests
-from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Type, TypeVar
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Type, TypeVar, AsyncIterator
+
+# aiohttp is imported by the transport on the first async request, so that sync runs do not load it
+HAS_AIOHTTP = importlib.util.find_spec("aiohttp") is not None
+
 
 class LocalAgent(Agent):
-    def __init__(self, url, **kwargs) -> None:
+    def __init__(self, url, read_timeout: float = None, **kwargs) -> None:
         super().__init__(**kwargs)
         self.url = url
-        self.parameters = kwargs
+        self.read_timeout = read_timeout  # None: long generations are not cut off by --read_timeout
+        # options of the harness itself are not sent to the model server
+        self.parameters = {key: value for key, value in kwargs.items() if key not in self.harness_options}
+
+    @property
+    def is_async(self) -> bool:
+        return HAS_AIOHTTP
 
     def inference(self, history: List[dict]) -> str:
-        resp = requests.post(self.url, json={
-            "messages": history,
-            **self.parameters
-        })
-        if resp.status_code != 200:
-            raise Exception(f"Invalid status code {resp.status_code}:\n\n{resp.text}")
+        def request():
+            resp = get_transport().post(self.url, json={
+                "messages": history,
+                **self.parameters
+            }, timeout=get_transport().with_read_timeout(self.read_timeout))
+            check_response(resp.status_code, resp.text, resp.headers)
+            try:
+                return resp.json().get("result")
+            except:
+                raise RetryableError(f"Invalid response:\n\n{resp.text}")
+        return self.retry.call(endpoint_of(self.url), request)
+
+    async def ainference(self, history: List[dict]) -> str:
+        async def request():
+            async with get_transport().async_session().post(self.url, json={
+                "messages": history,
+                **self.parameters
+            }, timeout=get_transport().async_timeout(self.read_timeout)) as resp:
+                text = await resp.text()
+            check_response(resp.status, text, resp.headers)
+            try:
+                return json.loads(text).get("result")
+            except:
+                raise RetryableError(f"Invalid response:\n\n{text}")
+        return await self.retry.acall(endpoint_of(self.url), request)
+
+
+async def aiter_events(content) -> AsyncIterator[Tuple[str, str]]:
+    """
+        (event name, data) of the server-sent events read from an aiohttp response body, the async side of SSEClient.
+    """
+    name, data = "message", []
+    async for line in content:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data:
+                yield name, "\n".join(data)
+            name, data = "message", []
+        elif line.startswith("event:"):
+            name = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            value = line[len("data:"):]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield name, "\n".join(data)
+
+
+class StreamingLocalAgent(LocalAgent):
+    """
+        LocalAgent that asks the server (`model_api_async`) for server-sent events with the output so far. It records
+        the time to the first output, and when the session's stop predicate matches it closes the stream, which
+        cancels the request on the server and frees its batch slot. A server that does not stream answers as usual.
+    """
+
+    supports_stop = True
+
+    def on_event(self, name: str, data: str, start: float, received: bool) -> Tuple[bool, Optional[str]]:
+        """
+            Whether the call is over after this event, and then its response.
+        """
+        if not received:
+            record_first_token(time.time() - start)
         try:
-            return resp.json().get("result")
-        except:
-            raise Exception(f"Invalid response:\n\n{resp.text}")
+            payload = json.loads(data)
+        except ValueError:
+            raise RetryableError(f"Invalid event:\n\n{data}")
+        if name == "result":
+            return True, payload.get("result")
+        text = payload.get("text", "")
+        end = stop_at(text)
+        if end is not None:  # leaving the with-block closes the stream and cancels the request
+            record_early_stop()
+            return True, text[:end]
+        return False, None
+
+    def inference(self, history: List[dict]) -> str:
+        def request():
+            start = time.time()
+            with get_transport().post(self.url, json={
+                "messages": history,
+                **self.parameters,
+                "stream": True,
+            }, stream=True, timeout=get_transport().with_read_timeout(self.read_timeout)) as resp:
+                check_response(resp.status_code, "" if resp.ok else resp.text, resp.headers)
+                if not resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+                    try:
+                        return resp.json().get("result")
+                    except:
+                        raise RetryableError(f"Invalid response:\n\n{resp.text}")
+                received = False
+                for event in SSEClient(resp.iter_content(chunk_size=None)).events():
+                    done, result = self.on_event(event.event, event.data, start, received)
+                    received = True
+                    if done:
+                        return result
+            raise RetryableError("Stream closed before the result")
+        return self.retry.call(endpoint_of(self.url), request)
+
+    async def ainference(self, history: List[dict]) -> str:
+        async def request():
+            start = time.time()
+            async with get_transport().async_session().post(self.url, json={
+                "messages": history,
+                **self.parameters,
+                "stream": True,
+            }, timeout=get_transport().async_timeout(self.read_timeout)) as resp:
+                if resp.status != 200 or resp.content_type != "text/event-stream":
+                    text = await resp.text()
+                    check_response(resp.status, text, resp.headers)
+                    try:
+                        return json.loads(text).get("result")
+                    except:
+                        raise RetryableError(f"Invalid response:\n\n{text}")
+                received = False
+                async for name, data in aiter_events(resp.content):
+                    done, result = self.on_event(name, data, start, received)
+                    received = True
+                    if done:
+                        return result
+            raise RetryableError("Stream closed before the result")
+        return await self.retry.acall(endpoint_of(self.url), request)
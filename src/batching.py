@@ -0,0 +1,136 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Callable
+
+
+class MicroBatcher:
+    """
+        Collects single `inference` calls from many sessions and sends them as one `batch_inference` call, once
+        `max_batch_size` histories are waiting or `max_wait_ms` after the first of them arrived. Batches are sent from
+        a small pool so that the next batch can form while one is in flight.
+    """
+
+    def __init__(self, batch_inference: Callable[[List[List[dict]]], List[str]], max_batch_size: int = 8,
+                 max_wait_ms: float = 20, concurrency: int = 4) -> None:
+        self.batch_inference = batch_inference
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, history: List[dict]) -> str:
+        future = Future()
+        with self.condition:
+            self.pending.append((history, future))
+            self.condition.notify()
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                deadline = time.time() + self.max_wait
+                while len(self.pending) < self.max_batch_size and not self.closed and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                batch = self.pending[:self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size:]
+                self.batches += 1
+                self.items += len(batch)
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch) -> None:
+        try:
+            results = self.batch_inference([history for history, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"batch_inference returned {len(results)} results for {len(batch)} histories")
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0,
+        }
+
+
+class AsyncMicroBatcher(MicroBatcher):
+    """
+        The same batching for coroutines on one event loop, sending batches through `abatch_inference`.
+    """
+
+    def __init__(self, abatch_inference: Callable, max_batch_size: int = 8, max_wait_ms: float = 20) -> None:
+        self.batch_inference = abatch_inference
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def __call__(self, history: List[dict]) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((history, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending[:self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size:]
+        if self.pending:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        if batch:
+            self.batches += 1
+            self.items += len(batch)
+            task = asyncio.ensure_future(self._send(batch))
+            self.tasks.add(task)  # keep a reference until the batch is done
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch) -> None:
+        try:
+            results = await self.batch_inference([history for history, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"abatch_inference returned {len(results)} results for {len(batch)} histories")
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Any, Callable
+
+from .agent import Agent, AgentLayer
+from .stop import current_stop
+
+
+def history_key(agent: Agent, history: List[dict]) -> str:
+    """
+        Content hash of the agent's generation parameters plus the full history sent to `inference`, and the stop
+        predicate for agents that honour it.
+    """
+    payload = {
+        "class": type(agent).__name__,
+        "params": agent.get_generation_params(),
+        "history": history,
+    }
+    if agent.supports_stop and current_stop():
+        payload["stop"] = current_stop()  # absent otherwise, so that existing keys stay valid
+    payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(AgentLayer):
+    """
+        On-disk (SQLite) response cache with LRU eviction. Configured from the agent YAML:
+
+            cache:
+                path: "cache/responses.sqlite"
+                max_entries: 100000
+                nondeterministic: false  # also cache calls with temperature > 0
+    """
+
+    name = "cache"
+
+    def __init__(self, path="cache/responses.sqlite", max_entries=100000, nondeterministic=False) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.nondeterministic = nondeterministic
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, last_access REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def enabled(self, agent: Agent) -> bool:
+        return self.nondeterministic or agent.is_deterministic()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+
+    def put(self, key: str, response: str) -> None:
+        with self.lock:
+            value = json.dumps(response, ensure_ascii=False)
+            updated = self.conn.execute(
+                "UPDATE responses SET response = ?, last_access = ? WHERE key = ?", (value, time.time(), key)
+            ).rowcount
+            if not updated:
+                self.conn.execute(
+                    "INSERT INTO responses (key, response, last_access) VALUES (?, ?, ?)", (key, value, time.time())
+                )
+                self.size += 1
+            if self.max_entries and self.size > self.max_entries:
+                self.evict(self.size - self.max_entries)
+
+    def evict(self, count: int) -> None:
+        self.conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)", (count,)
+        )
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.evictions += count
+
+    def __call__(self, agent: Agent, history: List[dict], inference: Callable[[List[dict]], str]) -> str:
+        if not self.enabled(agent):
+            return inference(history)
+        key = history_key(agent, history)
+        response = self.get(key)
+        if response is None:
+            response = inference(history)
+            if response is not None:
+                self.put(key, response)
+        return response
+
+    async def acall(self, agent: Agent, history: List[dict], ainference: Callable) -> str:
+        if not self.enabled(agent):
+            return await ainference(history)
+        key = history_key(agent, history)
+        response = self.get(key)
+        if response is None:
+            response = await ainference(history)
+            if response is not None:
+                self.put(key, response)
+        return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "evictions": self.evictions,
+            "entries": self.size,
+        }
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import statistics
+import threading
+from typing import Dict, Any, List
+
+
+class AdaptiveLimiter:
+    """
+        AIMD concurrency limit driven by observed model latency and errors.
+
+        The limit grows by one after each full round of successful items (additive increase) and is multiplied by
+        `backoff` when an item fails or retries (at most once per round, so one bad burst does not collapse it).
+        Latency is judged per window of at least `window` items and one round: the window's median is compared with
+        the baseline, the lowest window median seen, and a median above `tolerance` times the baseline cuts the limit
+        too. Single items are never compared, as the latency of one call varies with its output length regardless of
+        load. The baseline is forgotten slowly (it doubles every `baseline_window` seconds) so it can follow a server
+        that gets slower.
+    """
+
+    def __init__(self, min_limit: int = 1, max_limit: int = 64, initial: int = None, backoff: float = 0.7,
+                 tolerance: float = 2.0, baseline_window: float = 300.0, window: int = 32) -> None:
+        assert 1 <= min_limit <= max_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial or min_limit, min_limit), max_limit))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.baseline_window = baseline_window
+        self.baseline_time = time.time()
+        self.window = window
+        self.inflight = 0
+        self.latencies: List[float] = []  # of the current window
+        self.baseline = None
+        self.since_decrease = 0
+        self.samples = 0
+        self.decreases = 0
+        self.peak = self.limit
+        self.limit_sum = 0.0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config, workers: int, cap: int = None, initial: int = None) -> "AdaptiveLimiter":
+        """
+            `config` is the task's `adaptive_concurrency` value: True, or a dict with `min`, `max` and `initial`.
+            `max` defaults to `workers`, and is never above `cap` (the task's `worker_limit`).
+        """
+        config = config if isinstance(config, dict) else {}
+        max_limit = config.get("max", workers)
+        if cap:
+            max_limit = min(max_limit, cap)
+        min_limit = min(config.get("min", 1), max_limit)
+        return cls(min_limit, max_limit, initial or config.get("initial"))
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def update(self, latency: float = None, failed: bool = False) -> None:
+        self.samples += 1
+        self.since_decrease += 1
+        self.limit_sum += self.limit
+        congested = failed
+        if latency is not None and not failed:
+            self.latencies.append(latency)
+            if len(self.latencies) >= max(self.window, self.limit):
+                congested = self.judge_window()
+        if congested:
+            if self.since_decrease >= self.limit:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.since_decrease = 0
+                self.decreases += 1
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.peak = max(self.peak, self.limit)
+
+    def judge_window(self) -> bool:
+        """
+            Close the current window; True if its median latency is too far above the baseline.
+        """
+        median = statistics.median(self.latencies)
+        self.latencies = []
+        now = time.time()
+        if self.baseline is not None:
+            self.baseline *= 2 ** ((now - self.baseline_time) / self.baseline_window)
+        self.baseline_time = now
+        congested = self.baseline is not None and median > self.tolerance * self.baseline
+        self.baseline = median if self.baseline is None else min(median, self.baseline)
+        return congested
+
+    def record(self, latency: float = None, failed: bool = False) -> None:
+        """
+            Feed a sample without holding a slot, for callers that enforce the limit themselves (the global scheduler).
+        """
+        with self.condition:
+            self.update(latency, failed)
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.inflight >= self.current:
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency: float = None, failed: bool = False) -> None:
+        with self.condition:
+            self.inflight -= 1
+            self.update(latency, failed)
+            self.condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "min": self.min_limit,
+            "max": self.max_limit,
+            "final": self.current,
+            "peak": int(self.peak),
+            "mean": self.limit_sum / self.samples if self.samples else self.limit,
+            "decreases": self.decreases,
+        }
+
+
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    """
+        The same limiter for coroutines on one event loop.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.inflight < self.current)
+            self.inflight += 1
+
+    async def release(self, latency: float = None, failed: bool = False) -> None:
+        async with self.condition:
+            self.inflight -= 1
+            self.update(latency, failed)
+            self.condition.notify_all()
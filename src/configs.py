@@ -1,10 +1,11 @@
 from __future__ import annotations
+import threading
+from concurrent.futures import Future
 from dataclass_wizard import YAMLWizard
 from dataclasses import dataclass, field
 from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Type, TypeVar
 from src.agent import Agent
 from src.task import Task
-from src.tasks import ExampleTask
 
 
 @dataclass
@@ -12,18 +13,79 @@ class YAMLConfig(YAMLWizard):
     module: str = ""  # Agent module
     parameters: dict = field(default_factory=dict)  # Agent parameters
 
-    def create(self):
+    def get_class(self) -> Type:
         path = ".".join(self.module.split(".")[:-1])
         mod = __import__(path, fromlist=[self.module.split(".")[-1]])
         # print(mod)
-        return getattr(mod, self.module.split(".")[-1])(**self.parameters)
+        if not hasattr(mod, self.module.split(".")[-1]):
+            raise ValueError(f"Module '{path}' has no attribute '{self.module.split('.')[-1]}'")
+        return getattr(mod, self.module.split(".")[-1])
+
+    def create(self):
+        return self.get_class()(**self.parameters)
+
+    def validate(self) -> None:
+        """
+            Resolve the module and check the parameters without constructing anything.
+        """
+        if not isinstance(self.parameters, dict):
+            raise ValueError(f"Parameters of '{self.module}' must be a mapping")
+        validate_config = getattr(self.get_class(), "validate_config", None)
+        if validate_config:
+            validate_config(self.parameters)
 
     @classmethod
-    def create_from_yaml(cls, yaml_path: str, update_parameters: Union[None, Dict] = None) -> Union[Agent, Task]:
+    def load_from_yaml(cls, yaml_path: str, update_parameters: Union[None, Dict] = None) -> YAMLConfig:
         config = cls.from_yaml_file(yaml_path)
         if update_parameters:
             config.parameters.update(update_parameters)
-        # print(config.module)
         config.parameters["src"] = yaml_path
-        return config.create()
+        return config
+
+    @classmethod
+    def create_from_yaml(cls, yaml_path: str, update_parameters: Union[None, Dict] = None) -> Union[Agent, Task]:
+        return cls.load_from_yaml(yaml_path, update_parameters).create()
         # return ExampleTask(name="Test")
+
+
+class LazyTask:
+    """
+        A task config that is validated when loaded, while the Task itself (with its data, docker containers or tool
+        servers) is only built by `create`, or in the background by `prewarm`, and dropped again by `release`.
+    """
+
+    def __init__(self, yaml_path: str, update_parameters: Union[None, Dict] = None) -> None:
+        self.src = yaml_path
+        self.config = YAMLConfig.load_from_yaml(yaml_path, update_parameters)
+        self.config.validate()
+        self.name = self.config.parameters.get("name")
+        self.lock = threading.Lock()
+        self.future: Optional[Future] = None
+
+    def _claim(self) -> bool:
+        with self.lock:
+            if self.future is not None:
+                return False
+            self.future = Future()
+            return True
+
+    def _build(self) -> None:
+        try:
+            self.future.set_result(self.config.create())
+        except BaseException as e:
+            self.future.set_exception(e)
+
+    def prewarm(self) -> None:
+        if self._claim():
+            threading.Thread(target=self._build, daemon=True).start()
+
+    def create(self) -> Task:
+        if self._claim():
+            self._build()
+        return self.future.result()
+
+    def release(self) -> None:
+        with self.lock:
+            future, self.future = self.future, None
+        if future is not None and future.done() and not future.exception():
+            future.result().release()
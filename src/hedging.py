@@ -0,0 +1,170 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Callable, Optional
+
+import numpy as np
+
+from .agent import Agent, AgentLayer
+from .timing import detached_call
+from .transport import TRANSPORT_CONFIG
+
+
+class Hedging(AgentLayer):
+    """
+        Sends a duplicate of a deterministic call that has not returned within the `percentile` of recent latencies,
+        and returns whichever answers first. Configured from the agent YAML:
+
+            hedge:
+                percentile: 95
+                budget: 0.05  # at most this share of calls is duplicated
+                min_samples: 20  # latencies to observe before hedging starts
+
+        Behind a BalancedAgent the duplicate goes to the least busy endpoint, usually another one. An async loser is
+        cancelled; a sync one cannot be interrupted and finishes in the background, its answer discarded.
+
+        A sync call runs on a pool thread so that the caller can return the hedge's answer first. Hedges have a pool of
+        `max_threads` threads, by default `--workers` (the transport's `pool_size`), and primaries twice that, for the
+        losers still running; a call that finds every primary thread busy runs in the caller's thread, unhedged.
+    """
+
+    name = "hedge"
+
+    def __init__(self, percentile: float = 95, budget: float = 0.05, min_samples: int = 20, window: int = 1000,
+                 max_threads: int = None) -> None:
+        assert 0 < percentile < 100, "hedge percentile must be between 0 and 100"
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.max_threads = max_threads
+        self.executors = None  # primaries, hedges; created on the first hedged call, once --workers is known
+        self.slots = None  # free primary threads
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+
+    def delay(self) -> Optional[float]:
+        """
+            How long to wait before hedging this call, None if it may not be hedged.
+        """
+        with self.lock:
+            self.calls += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self.latencies, self.percentile))
+
+    def claim(self) -> bool:
+        with self.lock:
+            if self.hedged + 1 > self.budget * self.calls:
+                self.over_budget += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def observe(self, latency: float, hedge_won: bool = False) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            self.hedge_wins += hedge_won
+
+    def start_executors(self) -> None:
+        with self.lock:
+            if self.executors is None:
+                threads = self.max_threads or TRANSPORT_CONFIG["pool_size"]
+                self.slots = threading.BoundedSemaphore(2 * threads)
+                self.executors = (ThreadPoolExecutor(max_workers=2 * threads, thread_name_prefix="hedge-primary"),
+                                  ThreadPoolExecutor(max_workers=threads, thread_name_prefix="hedge"))
+
+    def submit(self, function: Callable, *args, detached: bool = False) -> Future:
+        context = contextvars.copy_context()  # keeps the call's timing record and stop predicate
+
+        def run():
+            if not detached:
+                return function(*args)
+            with detached_call():
+                return function(*args)
+        return self.executors[detached].submit(context.run, run)
+
+    def __call__(self, agent: Agent, history: List[dict], inference: Callable[[List[dict]], str]) -> str:
+        if not agent.is_deterministic():
+            return inference(history)
+        delay = self.delay()
+        if delay is None:
+            return self.observed(inference, history)
+        self.start_executors()
+        if not self.slots.acquire(blocking=False):
+            return self.observed(inference, history)
+        start = time.monotonic()
+        primary = self.submit(inference, history)
+        primary.add_done_callback(lambda _: self.slots.release())
+        done, _ = wait([primary], timeout=delay)
+        pending = {primary}
+        if not done and self.claim():
+            pending.add(self.submit(inference, history, detached=True))
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self.observe(time.monotonic() - start, future is not primary)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def acall(self, agent: Agent, history: List[dict], ainference: Callable) -> str:
+        if not agent.is_deterministic():
+            return await ainference(history)
+        delay = self.delay()
+        if delay is None:
+            start = time.monotonic()
+            result = await ainference(history)
+            self.observe(time.monotonic() - start)
+            return result
+
+        async def detached():
+            with detached_call():
+                return await ainference(history)
+
+        start = time.monotonic()
+        primary = asyncio.ensure_future(ainference(history))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self.claim():
+                pending.add(asyncio.ensure_future(detached()))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.observe(time.monotonic() - start, task is not primary)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def observed(self, inference: Callable, history: List[dict]) -> str:
+        start = time.monotonic()
+        result = inference(history)
+        self.observe(time.monotonic() - start)
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "over_budget": self.over_budget,
+                "hedge_rate": self.hedged / self.calls if self.calls else 0,
+                "delay": float(np.percentile(self.latencies, self.percentile)) if self.latencies else None,
+            }
@@ -0,0 +1,182 @@
+import time
+import asyncio
+import threading
+import contextvars
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+from .agent import Agent, AgentLayer
+from .timing import estimate_tokens, history_chars
+
+
+class TokenBucket:
+    """
+        Refills at `per_minute / 60` units per second up to `burst` seconds' worth. Callers reserve their cost up front
+        and are told how long to wait, so waiting callers are served in order at the refill rate instead of polling;
+        a cost larger than the bucket is allowed and simply waits longer.
+    """
+
+    def __init__(self, per_minute: float, burst: float = 10.0) -> None:
+        assert per_minute > 0, "rate limits must be positive"
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost: float) -> float:
+        """
+            Take `cost` from the bucket and return the seconds to wait before using it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float) -> None:
+        """
+            Return part of a reservation, or take more when `amount` is negative.
+        """
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimit:
+    """
+        The request and token buckets of one quota, shared by every agent and task in the process that uses it.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, burst: float = 10.0) -> None:
+        self.requests = TokenBucket(requests_per_minute, burst) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst) if tokens_per_minute else None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "tokens": 0, "throttled": 0, "wait_time": 0.0, "max_wait": 0.0}
+
+    def reserve(self, tokens: int, retry: bool = False) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["retries"] += retry
+            self.stats["tokens"] += tokens
+            if wait > 0:
+                self.stats["throttled"] += 1
+                self.stats["wait_time"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+        return wait
+
+    def adjust(self, tokens: int) -> None:
+        """
+            Correct the token reservation once the response length is known; `tokens` is what was over-reserved.
+        """
+        if self.tokens and tokens:
+            self.tokens.refund(tokens)
+            with self.lock:
+                self.stats["tokens"] -= tokens
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats)
+
+
+_limits: Dict[str, RateLimit] = {}
+_limits_lock = threading.Lock()
+
+
+def get_rate_limit(key: str, requests_per_minute: float = None, tokens_per_minute: float = None,
+                   burst: float = 10.0) -> RateLimit:
+    """
+        Limits are shared by key; the first caller sets the quota.
+    """
+    with _limits_lock:
+        if key not in _limits:
+            _limits[key] = RateLimit(requests_per_minute, tokens_per_minute, burst)
+        return _limits[key]
+
+
+class RateLimiter(AgentLayer):
+    """
+        Keeps the agent's upstream calls under a requests and (estimated) tokens per minute quota by delaying them.
+        Configured from the agent YAML:
+
+            rate_limit:
+                requests_per_minute: 500
+                tokens_per_minute: 90000
+                burst: 10  # seconds of quota that may be used at once
+                key: "my-gateway"  # agents with the same key share the quota, defaults to the agent name
+
+        Each call reserves its prompt tokens plus the agent's `max_new_tokens`, and gets back what the response did
+        not use. Every retry of the agent's retry policy is charged one more request and the prompt tokens again
+        (the average prompt when it runs outside the call's context, e.g. on a micro-batcher thread).
+    """
+
+    name = "rate_limit"
+
+    def __init__(self, agent: Agent, requests_per_minute: float = None, tokens_per_minute: float = None,
+                 burst: float = 10.0, key: str = None) -> None:
+        assert requests_per_minute or tokens_per_minute, \
+            "rate_limit needs requests_per_minute and/or tokens_per_minute"
+        self.limit = get_rate_limit(key or agent.name or type(agent).__name__, requests_per_minute,
+                                    tokens_per_minute, burst)
+        self.prompt_tokens = contextvars.ContextVar("rate_limit_prompt_tokens", default=None)
+        self.calls, self.total_prompt_tokens = 0, 0
+        agent.retry.hooks.append(self.before_attempt)
+
+    @staticmethod
+    def response_reserve(agent: Agent) -> int:
+        value = getattr(agent, "max_new_tokens", None)
+        return value if isinstance(value, int) else 0
+
+    def reserve(self, agent: Agent, history: List[dict]) -> Tuple[float, int]:
+        reserved = self.response_reserve(agent)
+        prompt_tokens = estimate_tokens(history_chars(history))
+        self.prompt_tokens.set(prompt_tokens)
+        with self.limit.lock:
+            self.calls += 1
+            self.total_prompt_tokens += prompt_tokens
+        return self.limit.reserve(prompt_tokens + reserved), reserved
+
+    def before_attempt(self, endpoint: str, attempt: int) -> float:
+        """
+            Retry policy hook: the first attempt was reserved by the call, each retry is another request.
+        """
+        if not attempt:
+            return 0.0
+        prompt_tokens = self.prompt_tokens.get()
+        if prompt_tokens is None:
+            with self.limit.lock:
+                prompt_tokens = self.total_prompt_tokens // max(1, self.calls)
+        return self.limit.reserve(prompt_tokens, retry=True)
+
+    def settle(self, reserved: int, response: Optional[str]) -> None:
+        used = estimate_tokens(len(response)) if isinstance(response, str) else 0
+        self.limit.adjust(reserved - used)
+
+    def __call__(self, agent: Agent, history: List[dict], inference: Callable[[List[dict]], str]) -> str:
+        wait, reserved = self.reserve(agent, history)
+        if wait:
+            time.sleep(wait)
+        response = None
+        try:
+            response = inference(history)
+            return response
+        finally:
+            self.settle(reserved, response)
+
+    async def acall(self, agent: Agent, history: List[dict], ainference: Callable) -> str:
+        wait, reserved = self.reserve(agent, history)
+        if wait:
+            await asyncio.sleep(wait)
+        response = None
+        try:
+            response = await ainference(history)
+            return response
+        finally:
+            self.settle(reserved, response)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.limit.get_stats()
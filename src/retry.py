@@ -0,0 +1,272 @@
+import sys
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, List, Optional, Callable
+from urllib.parse import urlsplit
+
+import requests
+
+from .timing import record_retry
+
+
+class RetryableError(Exception):
+    """
+        A failure worth retrying (rate limit, server error, malformed response). `retry_after` is the delay the
+        server asked for, in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RetryableError):
+    pass
+
+
+RETRYABLE_ERRORS = (RetryableError, requests.Timeout, requests.ConnectionError, asyncio.TimeoutError)
+
+
+def retryable_errors() -> tuple:
+    """
+        `RETRYABLE_ERRORS`, plus aiohttp's client errors once an async agent has imported aiohttp (none can be raised
+        before), so that sync runs do not load it.
+    """
+    aiohttp = sys.modules.get("aiohttp")
+    return RETRYABLE_ERRORS + (aiohttp.ClientError,) if aiohttp is not None else RETRYABLE_ERRORS
+
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+        The `Retry-After` header is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_response(status: int, text: str, headers=None) -> None:
+    if status == 200:
+        return
+    message = f"Invalid status code {status}:\n\n{text}"
+    if status in RETRYABLE_STATUS:
+        raise RetryableError(message, parse_retry_after((headers or {}).get("Retry-After")))
+    raise Exception(message)
+
+
+def endpoint_of(url: str) -> str:
+    return urlsplit(url).netloc or url
+
+
+class CircuitBreaker:
+    """
+        Per-endpoint circuit breaker. After `failure_threshold` consecutive failures the circuit opens and calls are
+        rejected without reaching the endpoint; after `reset_timeout` seconds one probe is let through (half-open),
+        and its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 10.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.stats = {"requests": 0, "failures": 0, "retries": 0, "rejected": 0, "gave_up": 0, "opens": 0}
+
+    def before(self) -> Optional[float]:
+        """
+            None if a request may be sent now, otherwise the number of seconds to wait before asking again.
+        """
+        with self.lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_timeout - time.time()
+                if remaining > 0:
+                    self.stats["rejected"] += 1
+                    return remaining
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open":
+                if self.probing:
+                    self.stats["rejected"] += 1
+                    return 0.0
+                self.probing = True
+            self.stats["requests"] += 1
+            return None
+
+    def available(self) -> bool:
+        """
+            Whether `before` would let a request through now, without claiming the half-open probe.
+        """
+        with self.lock:
+            if self.state == "open":
+                return time.time() >= self.opened_at + self.reset_timeout
+            return not (self.state == "half_open" and self.probing)
+
+    def success(self) -> None:
+        with self.lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.probing = False
+
+    def abandon(self) -> None:
+        """
+            The request was interrupted before it had an outcome; let another one probe.
+        """
+        with self.lock:
+            self.probing = False
+
+    def failure(self) -> None:
+        with self.lock:
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opens"] += 1
+                self.state = "open"
+                self.opened_at = time.time()
+                self.probing = False
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**self.stats, "state": self.state}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str, failure_threshold: int = 10, reset_timeout: float = 10.0) -> CircuitBreaker:
+    """
+        Breakers are shared by every agent that calls the same endpoint; the first caller sets the thresholds.
+    """
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(failure_threshold, reset_timeout)
+        return _breakers[endpoint]
+
+
+def get_retry_stats() -> Dict[str, Any]:
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    return {endpoint: breaker.get_stats() for endpoint, breaker in breakers}
+
+
+class RetryPolicy:
+    """
+        Retries a request with exponential backoff and full jitter (a random delay up to `base_delay * 2^attempt`,
+        capped at `max_delay`), never sooner than the server's `Retry-After`, and through the endpoint's circuit
+        breaker. Configured from the agent YAML:
+
+            retry: {max_attempts: 5, base_delay: 0.5, max_delay: 30, failure_threshold: 10, reset_timeout: 10}
+
+        Errors outside `retryable_errors()` (e.g. a 400 response) are raised at once. When every attempt fails the last
+        error is raised, so the item is recorded as failed instead of scored as an empty answer.
+
+        `hooks` are called with the endpoint and the attempt number before every attempt and return the seconds to
+        wait before sending it, e.g. the rate limit layer charges its quota for each retry.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 failure_threshold: int = 10, reset_timeout: float = 10.0) -> None:
+        assert max_attempts >= 1, "max_attempts must be at least 1"
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hooks: List[Callable[[str, int], float]] = []
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        return get_breaker(endpoint, self.failure_threshold, self.reset_timeout)
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def before_attempt(self, endpoint: str, attempt: int) -> float:
+        return max([hook(endpoint, attempt) for hook in self.hooks], default=0.0)
+
+    def attempt(self, breaker: CircuitBreaker) -> None:
+        wait = breaker.before()
+        if wait is not None:
+            raise CircuitOpenError("Circuit open, request not sent", wait)
+
+    def call(self, endpoint: str, request: Callable, *args, **kwargs):
+        breaker = self.breaker(endpoint)
+        for attempt in range(self.max_attempts):
+            if attempt:
+                record_retry()
+                breaker.count("retries")
+            wait = self.before_attempt(endpoint, attempt)
+            if wait:
+                time.sleep(wait)
+            try:
+                self.attempt(breaker)
+                try:
+                    result = request(*args, **kwargs)
+                except retryable_errors():
+                    breaker.failure()
+                    raise
+                except Exception:
+                    breaker.success()  # the endpoint answered, the request itself is wrong
+                    raise
+                except BaseException:
+                    breaker.abandon()
+                    raise
+                breaker.success()
+                return result
+            except retryable_errors() as e:
+                if attempt + 1 == self.max_attempts:
+                    breaker.count("gave_up")
+                    raise
+                time.sleep(self.delay(attempt, getattr(e, "retry_after", None)))
+
+    async def acall(self, endpoint: str, request: Callable, *args, **kwargs):
+        breaker = self.breaker(endpoint)
+        for attempt in range(self.max_attempts):
+            if attempt:
+                record_retry()
+                breaker.count("retries")
+            wait = self.before_attempt(endpoint, attempt)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                self.attempt(breaker)
+                try:
+                    result = await request(*args, **kwargs)
+                except retryable_errors():
+                    breaker.failure()
+                    raise
+                except Exception:
+                    breaker.success()
+                    raise
+                except BaseException:  # cancelled
+                    breaker.abandon()
+                    raise
+                breaker.success()
+                return result
+            except retryable_errors() as e:
+                if attempt + 1 == self.max_attempts:
+                    breaker.count("gave_up")
+                    raise
+                await asyncio.sleep(self.delay(attempt, getattr(e, "retry_after", None)))
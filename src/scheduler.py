@@ -0,0 +1,92 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict
+
+
+class TaskQueue:
+    def __init__(self, limit: int, expected_cost: float) -> None:
+        self.limit = limit
+        self.expected_cost = expected_cost
+        self.jobs = deque()
+        self.running = 0
+        self.finished = 0
+        self.total_time = 0.0
+
+    def mean_time(self):
+        return self.total_time / self.finished if self.finished else None
+
+
+class Scheduler:
+    """
+        One shared pool of `workers` threads for the items of every task.
+
+        Each task runs at most `limit` items at a time (its `worker_limit`). Whenever a worker is free, it takes the
+        next item of the eligible task with the most expected remaining work (queued items times the expected time
+        per item), so long-tail tasks start first and short ones fill the gaps.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.queues: Dict[Any, TaskQueue] = {}
+        self.condition = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def register(self, task, limit: int, expected_cost: float = 1.0) -> None:
+        with self.condition:
+            if task not in self.queues:
+                self.queues[task] = TaskQueue(limit, expected_cost)
+            else:
+                self.queues[task].limit = limit
+
+    def submit(self, task, fn: Callable, *args) -> Future:
+        future = Future()
+        with self.condition:
+            self.queues[task].jobs.append((future, fn, args))
+            self.condition.notify()
+        return future
+
+    def expected_item_time(self, queue: TaskQueue) -> float:
+        mean = queue.mean_time()
+        if mean is not None:
+            return mean
+        observed = [q.mean_time() / q.expected_cost for q in self.queues.values() if q.finished]
+        scale = sum(observed) / len(observed) if observed else 1.0
+        return queue.expected_cost * scale
+
+    def _pick(self):
+        best, best_work = None, -1
+        for queue in self.queues.values():
+            if not queue.jobs or queue.running >= queue.limit:
+                continue
+            work = len(queue.jobs) * self.expected_item_time(queue)
+            if work > best_work:
+                best, best_work = queue, work
+        return best
+
+    def _worker(self) -> None:
+        while True:
+            with self.condition:
+                queue = self._pick()
+                while queue is None:
+                    self.condition.wait()
+                    queue = self._pick()
+                future, fn, args = queue.jobs.popleft()
+                queue.running += 1
+            if future.set_running_or_notify_cancel():
+                start = time.time()
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+                elapsed = time.time() - start
+            else:
+                elapsed = None
+            with self.condition:
+                queue.running -= 1
+                if elapsed is not None:
+                    queue.finished += 1
+                    queue.total_time += elapsed
+                self.condition.notify_all()
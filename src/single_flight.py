@@ -0,0 +1,95 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import List, Dict, Any, Callable
+
+from .agent import Agent, AgentLayer
+from .cache import history_key
+
+
+class SingleFlight(AgentLayer):
+    """
+        Coalesces concurrent calls with the same (params, history): the first one goes upstream and the others wait
+        for its result. Configured from the agent YAML:
+
+            single_flight: auto  # auto (only when temperature is 0), true or false
+    """
+
+    name = "single_flight"
+
+    def __init__(self, mode="auto") -> None:
+        assert mode in ("auto", True, False), "single_flight must be auto, true or false"
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.calls: Dict[str, Future] = {}
+        self.acalls: Dict[tuple, asyncio.Future] = {}
+        self.upstream = 0
+        self.shared = 0
+
+    def enabled(self, agent: Agent) -> bool:
+        if self.mode == "auto":
+            return agent.is_deterministic()
+        return self.mode
+
+    def __call__(self, agent: Agent, history: List[dict], inference: Callable[[List[dict]], str]) -> str:
+        if not self.enabled(agent):
+            return inference(history)
+        key = history_key(agent, history)
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.upstream += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = inference(history)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def acall(self, agent: Agent, history: List[dict], ainference: Callable) -> str:
+        if not self.enabled(agent):
+            return await ainference(history)
+        loop = asyncio.get_running_loop()
+        key = (id(loop), history_key(agent, history))  # futures cannot be awaited across event loops
+        with self.lock:
+            future = self.acalls.get(key)
+            leader = future is None
+            if leader:
+                future = self.acalls[key] = loop.create_future()
+                self.upstream += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return await asyncio.shield(future)
+        try:
+            result = await ainference(history)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved when nobody else is waiting
+            raise
+        finally:
+            with self.lock:
+                del self.acalls[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.upstream + self.shared
+        return {
+            "upstream": self.upstream,
+            "shared": self.shared,
+            "shared_rate": self.shared / total if total else 0,
+        }
@@ -0,0 +1,167 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from typing import Dict, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SINK_CONFIG = {
+    "flush_interval": 1.0,  # seconds between batched writes
+    "max_batch_lines": 1000,  # lines that are written at once, even before `flush_interval` is over
+    "fsync_interval": None,  # seconds between fsync calls, None to leave it to the OS
+    "compression": None,  # None or "zstd"
+}
+
+_sinks: Dict[str, "OutputSink"] = {}
+_sinks_lock = threading.Lock()
+
+
+def configure_sinks(**config) -> None:
+    for key, value in config.items():
+        if key not in SINK_CONFIG:
+            raise ValueError(f"Unknown sink option '{key}'")
+        SINK_CONFIG[key] = value
+    if SINK_CONFIG["compression"] not in (None, "zstd"):
+        raise ValueError(f"Unsupported compression '{SINK_CONFIG['compression']}'")
+    if SINK_CONFIG["compression"] == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the 'zstandard' package")
+
+
+class OutputSink:
+    """
+        Appends lines to one file from a single background thread, so writers from many threads never reopen the
+        file or interleave partial lines. Lines are written in batches every `flush_interval` seconds, or every
+        `max_batch_lines` lines if that comes first.
+    """
+
+    def __init__(self, path: str, mode: str = "a", compression: Optional[str] = None) -> None:
+        self.path = path
+        self.compression = compression
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, mode + "b")
+        self.compressor = zstandard.ZstdCompressor() if compression == "zstd" else None
+        self.queue = queue.Queue()
+        self.last_fsync = time.time()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, line: str) -> None:
+        self.queue.put(line)
+
+    def flush(self) -> None:
+        """
+            Block until every line written so far is on disk.
+        """
+        event = threading.Event()
+        self.queue.put(event)
+        event.wait()
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        with _sinks_lock:
+            if _sinks.get(self.path) is self:
+                del _sinks[self.path]
+
+    def _write_batch(self, lines, fsync=False) -> None:
+        if lines:
+            data = "".join(lines).encode("utf-8")
+            if self.compressor:
+                data = self.compressor.compress(data)  # one frame per batch, so a crash loses at most one batch
+            self.file.write(data)
+            lines.clear()
+        self.file.flush()
+        interval = SINK_CONFIG["fsync_interval"]
+        if fsync or (interval is not None and time.time() - self.last_fsync >= interval):
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+
+    def _run(self) -> None:
+        lines = []
+        deadline = time.time() + SINK_CONFIG["flush_interval"]
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                self._write_batch(lines)
+                deadline = time.time() + SINK_CONFIG["flush_interval"]
+                continue
+            if isinstance(item, str):
+                lines.append(item)
+                # a busy queue never times out, so check here too
+                if len(lines) >= SINK_CONFIG["max_batch_lines"] or time.time() >= deadline:
+                    self._write_batch(lines)
+                    deadline = time.time() + SINK_CONFIG["flush_interval"]
+                continue
+            self._write_batch(lines, fsync=SINK_CONFIG["fsync_interval"] is not None)
+            if item is None:
+                self.file.close()
+                return
+            item.set()
+
+
+def get_sink(path: str, mode: str = "a", compress: bool = True) -> OutputSink:
+    """
+        Return the process-wide sink for `path` (with a `.zst` suffix if zstd compression is configured). Mode "w"
+        truncates the file and replaces any open sink for it.
+    """
+    compression = SINK_CONFIG["compression"] if compress else None
+    if compression == "zstd":
+        path += ".zst"
+    with _sinks_lock:
+        sink = _sinks.get(path)
+        if sink is None:
+            sink = _sinks[path] = OutputSink(path, mode, compression)
+            return sink
+        if mode == "a":
+            return sink
+    sink.close()
+    with _sinks_lock:
+        sink = _sinks[path] = OutputSink(path, mode, compression)
+    return sink
+
+
+def flush_sinks() -> None:
+    for sink in list(_sinks.values()):
+        sink.flush()
+
+
+def close_sinks() -> None:
+    for sink in list(_sinks.values()):
+        sink.close()
+
+
+atexit.register(close_sinks)
+
+
+def read_lines(path: str) -> Iterator[str]:
+    """
+        Iterate over the lines of a file written by a sink, compressed (`path` + ".zst") or not.
+    """
+    if os.path.exists(path + ".zst"):
+        if zstandard is None:
+            raise ImportError(f"Reading '{path}.zst' requires the 'zstandard' package")
+        with open(path + ".zst", "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            buffer = b""
+            while True:
+                try:
+                    chunk = reader.read(1 << 16)
+                except zstandard.ZstdError:  # the last frame of a crashed run may be truncated
+                    chunk = b""
+                if not chunk:
+                    break
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    yield line.decode("utf-8") + "\n"
+            if buffer:
+                yield buffer.decode("utf-8", errors="replace")
+    elif os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            yield from f
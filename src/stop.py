@@ -0,0 +1,83 @@
+import re
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Optional, Callable
+
+_current_stop = contextvars.ContextVar("stop_predicate", default=None)
+
+
+def json_object(text: str) -> Optional[int]:
+    """
+        End of the first complete top-level JSON object (braces inside strings are skipped).
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth, in_string, escaped = 0, False, False
+    for position in range(start, len(text)):
+        char = text[position]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return position + 1
+    return None
+
+
+_CODE_BLOCK = re.compile(r"```[^\n]*\n.*?```", re.DOTALL)
+
+
+def code_block(text: str) -> Optional[int]:
+    """
+        End of the first closed ``` fenced block.
+    """
+    match = _CODE_BLOCK.search(text)
+    return match.end() if match else None
+
+
+# Each predicate gets the text generated so far and returns where the useful part ends, or None to keep going.
+STOP_PREDICATES: Dict[str, Callable[[str], Optional[int]]] = {
+    "json_object": json_object,
+    "code_block": code_block,
+}
+
+
+def validate_stop(name: Optional[str]) -> None:
+    if name is not None and name not in STOP_PREDICATES:
+        raise ValueError(f"Unknown stop predicate '{name}', expected one of {', '.join(STOP_PREDICATES)}")
+
+
+@contextmanager
+def stop_scope(name: Optional[str]):
+    """
+        Make the session's stop predicate visible to the agent for the duration of one model call.
+    """
+    token = _current_stop.set(name)
+    try:
+        yield
+    finally:
+        _current_stop.reset(token)
+
+
+def current_stop() -> Optional[str]:
+    return _current_stop.get()
+
+
+def stop_at(text: str) -> Optional[int]:
+    """
+        Where the current call's output can be cut, None if it has no stop predicate or the predicate does not match.
+    """
+    name = _current_stop.get()
+    if name is None:
+        return None
+    return STOP_PREDICATES[name](text)
@@ -20,6 +20,7 @@ class Task:
 import os
 import time
 import json
+import asyncio
 import jsonlines
 import traceback
 import threading
@@ -39,6 +40,7 @@ import time
 import re
 import math
 import random
+import hashlib
 import datetime
 import argparse
 import requests
@@ -47,6 +49,12 @@ import requests
 # from .model_api import get_model_api
 from .agent import Agent, Session
 from .utils import serialize
+from .sink import get_sink, read_lines
+from .timing import ItemTimer, track_item, summarize
+from .concurrency import AdaptiveLimiter, AsyncAdaptiveLimiter
+from .transport import get_transport
+from .batching import MicroBatcher, AsyncMicroBatcher
+from .stop import validate_stop
 
 
 T_INPUT = TypeVar('T_INPUT')
@@ -69,6 +77,9 @@ class Dataset(Generic[T_INPUT, T_TARGET], List[DataPiece[T_INPUT, T_TARGET]]):
 
 
 class Task(Generic[T_INPUT, T_OUTPUT, T_TARGET]):
+    expected_item_cost = 1.0  # relative time per item, used by the global scheduler before any item has finished
+    stop = None  # stop predicate of the task's model calls, see src.stop
+
     def __init__(self, **kwargs):
         self.name = kwargs.pop("name", None)
         self.worker_limit = kwargs.pop("worker_limit", None)
@@ -76,15 +87,45 @@ class Task(Generic[T_INPUT, T_OUTPUT, T_TARGET]):
         self.category = kwargs.pop("category", None)
         self.src = kwargs.pop("src", None)
         self.output_root_dir = kwargs.pop("output_root_dir", None)
+        self.resume = kwargs.pop("resume", False)
+        self.expected_item_cost = kwargs.pop("expected_item_cost", self.expected_item_cost)
+        self.adaptive_concurrency = kwargs.pop("adaptive_concurrency", None)
+        self.limiter = None
+        self.micro_batch = kwargs.pop("micro_batch", None)
+        self.stop = kwargs.pop("stop", self.stop)
+        validate_stop(self.stop)
+        self.batcher = None
+        self._batch_stats = {"batches": 0, "items": 0}
+        self.scheduler = None
+        self._generations = None
+        self._timings: List[ItemTimer] = []
+        self._predict_time = 0.0
         assert isinstance(self.workers, int) and self.workers > 0
         assert isinstance(self.name, str)
         # if kwargs:
         #     for key in kwargs:
         #         print(f"Warning: Unknown argument '{key}' for the task.")
 
+    @classmethod
+    def validate_config(cls, parameters: Dict[str, Any]) -> None:
+        """
+            Check the YAML parameters at load time, before the task builds its data or environment.
+        """
+        if not isinstance(parameters.get("name"), str):
+            raise ValueError(f"Task config '{parameters.get('src')}' needs a string 'name'")
+        if not isinstance(parameters.get("workers", 1), int) or parameters.get("workers", 1) <= 0:
+            raise ValueError(f"'workers' of task '{parameters['name']}' must be a positive integer")
+        validate_stop(parameters.get("stop"))
+
     def release(self):
         pass
 
+    def set_scheduler(self, scheduler) -> None:
+        """
+            Submit the items of this task to a shared `src.scheduler.Scheduler` instead of a private thread pool.
+        """
+        self.scheduler = scheduler
+
     def evaluate(self, agent: Agent) -> Dict[str, Any]:
         print(f"Evaluating task '{self.name}' ...")
         data = self.get_data()
@@ -98,50 +139,237 @@ class Task(Generic[T_INPUT, T_OUTPUT, T_TARGET]):
         self.save_runs_all(inputs, results, targets, result_dict)
         return result_dict
 
+    @property
+    def is_async(self) -> bool:
+        """
+            True if the task implements `apredict_single`, i.e. it can be run on the asyncio path.
+        """
+        return type(self).apredict_single is not Task.apredict_single
+
     def predict_all(self, agent: Agent, inputs: List[T_INPUT]) -> List[T_OUTPUT]:
         print(f"Start Predicting All ...")
+        start = time.time()
+
+        results = [None] * len(inputs)
+        indices = list(range(len(inputs)))
+        if self.resume:
+            indices = self.restore_generations(inputs, results)
+            print(f"Resumed {len(inputs) - len(indices)} items from generation.jsonl, {len(indices)} remaining")
 
         thread_count = self.workers
         if self.worker_limit:
             thread_count = min(self.workers, self.worker_limit)
 
-        executor = ThreadPoolExecutor(max_workers=thread_count)
+        use_async = self.is_async and agent.is_async and not self.scheduler
+        if self.adaptive_concurrency:
+            self.limiter = (AsyncAdaptiveLimiter if use_async else AdaptiveLimiter).from_config(
+                self.adaptive_concurrency, self.workers, self.worker_limit,
+                initial=self.limiter.current if self.limiter else None,  # carry the limit over between calls
+            )
+            thread_count = self.limiter.current if self.scheduler else self.limiter.max_limit
+
+        self.batcher = self.create_batcher(agent, use_async, thread_count)
+
+        if use_async:
+            asyncio.run(self.apredict_all(agent, inputs, indices, results, thread_count))
+            self._predict_time += time.time() - start
+            self.report_concurrency()
+            self.close_batcher()
+            return results
+
+        if self.scheduler:
+            self.scheduler.register(self, thread_count, self.expected_item_cost)
+            submit = lambda *args: self.scheduler.submit(self, *args)
+        else:
+            submit = ThreadPoolExecutor(max_workers=thread_count).submit
 
         threads = []
-        results = [None] * len(inputs)
 
-        def call_wrap(data_item, index):
-            try:
-                result = self.predict_single(agent.create_session(), data_item)
-                self.save_single(index, data_item, result)
-            except:
-                pass
+        def call_wrap(data_item, index, submitted):
+            if self.limiter and not self.scheduler:
+                self.limiter.acquire()
+            failed = False
+            with track_item(index, submitted) as item:
+                try:
+                    session = agent.create_session(inference=self.batcher, stop=self.stop)
+                    result = self.predict_single(session, data_item)
+                    self.save_single(index, data_item, result)
+                except:
+                    failed = item.failed = True
+            self.save_timing(item)
+            if self.limiter:
+                self.limiter_feedback(item, failed)
             results[index] = result
 
-        for idx, item in enumerate(inputs):
-            future = executor.submit(call_wrap, item, idx)
+        for idx in indices:
+            future = submit(call_wrap, inputs[idx], idx, time.time())
             threads.append(future)
 
-        with tqdm(total=len(inputs)) as pbar:
+        with tqdm(total=len(indices)) as pbar:
             for thread in as_completed(threads):
                 pbar.update(1)
 
+        self.flush_outputs(indices)
+        self._predict_time += time.time() - start
+        self.report_concurrency()
+        self.close_batcher()
         return results
 
+    async def apredict_all(self, agent: Agent, inputs: List[T_INPUT], indices: List[int], results: List[T_OUTPUT],
+                           concurrency: int) -> None:
+        """
+            Run the items at `indices` on one event loop, with at most `concurrency` sessions in flight.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call_wrap(data_item, index, submitted):
+            await (self.limiter or semaphore).acquire()
+            failed = True
+            try:
+                with track_item(index, submitted) as item:
+                    session = agent.create_session(ainference=self.batcher, stop=self.stop)
+                    result = await self.apredict_single(session, data_item)
+                failed = False
+            except Exception:
+                return
+            finally:
+                self.save_timing(item)
+                if self.limiter:
+                    await self.limiter.release(item.model_latency, failed or item.retries > 0)
+                else:
+                    semaphore.release()
+            results[index] = result
+            self.save_single(index, data_item, result)
+
+        submitted = time.time()
+        coroutines = [call_wrap(inputs[idx], idx, submitted) for idx in indices]
+        with tqdm(total=len(indices)) as pbar:
+            for coroutine in asyncio.as_completed(coroutines):
+                await coroutine
+                pbar.update(1)
+        await get_transport().aclose()  # the client session belongs to this event loop
+        self.flush_outputs(indices)
+
+    @staticmethod
+    def content_hash(obj) -> str:
+        return hashlib.md5(json.dumps(serialize(obj), sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def load_generations(self) -> Dict[Tuple[int, str], Any]:
+        """
+            Index the existing generation.jsonl by (item index, input content hash).
+        """
+        if self._generations is None:
+            self._generations = {}
+            path = os.path.join(self.get_output_dir(), "generation.jsonl")
+            lines, damaged = [], False
+            for line in read_lines(path):
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:  # the last line of a crashed run may be incomplete
+                    damaged = True
+                    continue
+                lines.append(line if line.endswith("\n") else line + "\n")
+                self._generations[(item["index"], self.content_hash(item["input"]))] = item["output"]
+            if damaged:  # rewrite the valid rows so that new ones are appended to a clean file
+                sink = get_sink(path, "w")
+                for line in lines:
+                    sink.write(line)
+                sink.flush()
+        return self._generations
+
+    def restore_generations(self, inputs: List[T_INPUT], results: List[T_OUTPUT]) -> List[int]:
+        """
+            Fill `results` with the outputs already in generation.jsonl, and return the indices still to predict.
+        """
+        generations = self.load_generations()
+        pending = []
+        for idx, item in enumerate(inputs):
+            key = (idx, self.content_hash(item))
+            if key in generations:
+                results[idx] = self.deserialize_output(generations[key])
+            else:
+                pending.append(idx)
+        return pending
+
+    def deserialize_output(self, output: Any) -> T_OUTPUT:
+        """
+            Turn an output read back from generation.jsonl (its `serialize`d form) into what `predict_single` returns.
+            Tasks whose outputs are not plain JSON types override this, so that resumed items are scored like new ones.
+        """
+        return output
+
+    def flush_outputs(self, indices: List[int]) -> None:
+        if indices:
+            get_sink(os.path.join(self.get_output_dir(), "generation.jsonl")).flush()
+            get_sink(os.path.join(self.get_output_dir(), "timings.jsonl")).flush()
+
+    def limiter_feedback(self, item: ItemTimer, failed: bool) -> None:
+        failed = failed or item.retries > 0
+        if self.scheduler:
+            self.limiter.record(item.model_latency, failed)
+            self.scheduler.register(self, self.limiter.current, self.expected_item_cost)
+        else:
+            self.limiter.release(item.model_latency, failed)
+
+    def create_batcher(self, agent: Agent, use_async: bool, concurrency: int):
+        """
+            With `micro_batch` set (a batch size, or {size, wait_ms}) and an agent that supports batching, model calls
+            of concurrent sessions are grouped into `batch_inference` requests.
+        """
+        if not self.micro_batch or not agent.supports_batching:
+            return None
+        config = self.micro_batch if isinstance(self.micro_batch, dict) else {"size": self.micro_batch}
+        size, wait_ms = config.get("size", 8), config.get("wait_ms", 20)
+        if use_async:
+            return AsyncMicroBatcher(agent.abatch_inference, size, wait_ms)
+        return MicroBatcher(agent.batch_inference, size, wait_ms, concurrency=max(1, -(-concurrency // size)))
+
+    def close_batcher(self) -> None:
+        if self.batcher:
+            self.batcher.close()
+            self._batch_stats["batches"] += self.batcher.batches
+            self._batch_stats["items"] += self.batcher.items
+            self.batcher = None
+
+    def report_concurrency(self) -> None:
+        if self.limiter:
+            stats = self.limiter.get_stats()
+            print(f"Adaptive concurrency of '{self.name}' converged to {stats['final']} "
+                  f"(peak {stats['peak']}, mean {stats['mean']:.1f}, {stats['decreases']} decreases, "
+                  f"range {stats['min']}-{stats['max']})")
+
+    def save_timing(self, item: ItemTimer) -> None:
+        self._timings.append(item)
+        get_sink(os.path.join(self.get_output_dir(), "timings.jsonl")).write(json.dumps(item.to_dict()) + "\n")
+
+    def get_timing_summary(self) -> Dict[str, Any]:
+        """
+            Latency percentiles and throughput over the items predicted by this run, None if there were none.
+        """
+        if not self._timings:
+            return None
+        summary = summarize(self._timings, self._predict_time)
+        if self.limiter:
+            summary["concurrency"] = self.limiter.get_stats()
+        if self._batch_stats["batches"]:
+            summary["batching"] = {
+                **self._batch_stats,
+                "mean_batch_size": self._batch_stats["items"] / self._batch_stats["batches"],
+            }
+        return summary
+
     def save_single(self, index: int, input: T_INPUT, output: T_OUTPUT):
         save_obj = {
             "index": index,
             "input": serialize(input),
             "output": serialize(output)
         }
-        if not os.path.exists(self.get_output_dir()):
-            os.makedirs(self.get_output_dir())
-        with open(os.path.join(self.get_output_dir(), "generation.jsonl"), "a", encoding="utf-8") as f:
-            f.write(json.dumps(save_obj, ensure_ascii=False) + "\n")
+        get_sink(os.path.join(self.get_output_dir(), "generation.jsonl")).write(
+            json.dumps(save_obj, ensure_ascii=False) + "\n"
+        )
 
     def save_runs_all(self, inputs: List[T_INPUT], outputs: List[T_OUTPUT], targets: List[T_TARGET], metrics: Dict[str, Any] = None):
-        if not os.path.exists(self.get_output_dir()):
-            os.makedirs(self.get_output_dir())
+        sink = get_sink(os.path.join(self.get_output_dir(), "runs.jsonl"), "w")
         for idx, (input, output, target) in enumerate(zip(inputs, outputs, targets)):
             save_obj = {
                 "index": idx,
@@ -149,15 +377,17 @@ class Task(Generic[T_INPUT, T_OUTPUT, T_TARGET]):
                 "output": serialize(output),
                 "target": serialize(target)
             }
-            with open(os.path.join(self.get_output_dir(), "runs.jsonl"), "a", encoding="utf-8") as f:
-                f.write(json.dumps(save_obj) + "\n")
+            sink.write(json.dumps(save_obj) + "\n")
+        sink.close()
         self.save_metrics_all(metrics)
 
     def save_metrics_all(self, metrics: Dict[str, Any]):
-        if not os.path.exists(self.get_output_dir()):
-            os.makedirs(self.get_output_dir())
-        with open(os.path.join(self.get_output_dir(), "results.json"), "w", encoding="utf-8") as f:
-            f.write(json.dumps(metrics, indent=4))
+        timings = self.get_timing_summary()
+        if timings and isinstance(metrics, dict):
+            metrics = {**metrics, "timings": timings}
+        sink = get_sink(os.path.join(self.get_output_dir(), "results.json"), "w", compress=False)
+        sink.write(json.dumps(metrics, indent=4))
+        sink.close()
 
     def get_output_dir(self) -> str:
         """
@@ -176,3 +406,6 @@ class Task(Generic[T_INPUT, T_OUTPUT, T_TARGET]):
 
     def predict_single(self, session: Session, data_item: T_INPUT) -> T_OUTPUT:
         raise NotImplementedError
+
+    async def apredict_single(self, session: Session, data_item: T_INPUT) -> T_OUTPUT:
+        raise NotImplementedError
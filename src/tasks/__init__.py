@@ -1,42 +1,36 @@
-from .example_task import ExampleTask
+import importlib
 
-try:
-    from .humaneval_x import HumanEvalXGenerationTask, HumanEvalXTranslationTask
-except:
-    print("> [Warning] HumanEvalX Import Failed")
-'''
-try:
-    from .mbpp import MBPPTask
-except:
-    print("> [Warning] MBPPTask Import Failed")
-try:
-    from .tool_execution import ToolExecution
-except:
-    print("> [Warning] ToolExecution Import Failed")'''
-# try:
-from .single_round_tasks import *
-# except:
-#     print("> [Warning] Single Round Tasks Import Failed")
-'''try:
-    from .composite_task import CompositeTask
-except:
-    print("> [Warning] CompositeTask Import Failed")
-try:
-    from .apibench import Apibench
-except:
-    print("> [Warning] Apibench Import Failed")
-try:
-    from .os_interaction import OSInteraction
-except:
-    print("> [Warning] OSInteraction Import Failed")
-try:
-    from .extraction import MUL_ExtractionTask
-except:
-    print("> [Warning] Extraction Import Failed")
-try:
-    from .scibench import ScibenchTask, ScibenchTask_cot
-except:
-    print("> [Warning] scibench Import Failed")'''
+# Task classes are imported on first access, e.g. when a YAML config names `src.tasks.SingleRoundTask`, so that one
+# task does not pay for the dependencies (torch, docker, nltk, ...) of all the others.
+_TASK_MODULES = {
+    "ExampleTask": ".example_task",
+    "HumanEvalXGenerationTask": ".humaneval_x",
+    "HumanEvalXTranslationTask": ".humaneval_x",
+    "MBPPTask": ".mbpp",
+    "ToolExecution": ".tool_execution",
+    "SingleRoundTask": ".single_round_tasks",
+    "CompositeTask": ".composite_task",
+    "Apibench": ".apibench",
+    "OSInteraction": ".os_interaction",
+    "DBBench": ".dbbench",
+    "ScibenchTask": ".scibench",
+    "ScibenchTask_cot": ".scibench",
+    "CEvalTask": ".ceval",
+    "ToxiGenTask": ".toxigen",
+    "IdentityTask": ".self_identity",
+    "InferTask": ".infer",
+    "disambiguityQA": ".disambiguity",
+    "IdiotQATask": ".idiotQA",
+}
 
-from .disambiguity import disambiguityQA
-from .idiotQA import IdiotQATask
\ No newline at end of file
+
+def __getattr__(name):
+    if name not in _TASK_MODULES:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    value = getattr(importlib.import_module(_TASK_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_TASK_MODULES))
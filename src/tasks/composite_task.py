@@ -1,5 +1,5 @@
 from src.task import Task, Dataset, DataPiece, Session
-from src.configs import YAMLConfig
+from src.configs import YAMLConfig, LazyTask
 import os
 import json
 import sys
@@ -13,28 +13,63 @@ import requests
 from src.agent import Agent, Session
 from src.utils import serialize
 from typing import Dict, Callable, Type, Tuple, List, Any, Union, Iterable, Generic, TypeVar
+from concurrent.futures import ThreadPoolExecutor
 
 
 class CompositeTask(Task):
     def __init__(self, **configs):
         tasks = configs.pop("tasks", [])
-        self.tasks: List[Task] = []
+        self.tasks: List[LazyTask] = []
         super().__init__(**configs)
         for task in tasks:
             assert "src" in task
+            task = dict(task)
             if self.workers:
                 task.update({"workers": self.workers})
+            task.update({"resume": self.resume})
+            if self.adaptive_concurrency and "adaptive_concurrency" not in task:
+                task.update({"adaptive_concurrency": self.adaptive_concurrency})
             src = os.path.join(os.path.dirname(configs["src"]), task.pop("src"))
-            sub_task = YAMLConfig.create_from_yaml(src, task)
-            sub_task.get_output_dir = (lambda s: (lambda: self._sub_output_dir(s)))(sub_task)
-            self.tasks.append(sub_task)
+            self.tasks.append(LazyTask(src, task))  # sub-tasks are built one at a time in evaluate
+
+    @classmethod
+    def validate_config(cls, parameters):
+        super().validate_config(parameters)
+        for task in parameters.get("tasks", []):
+            if "src" not in task:
+                raise ValueError(f"Sub-task of '{parameters['name']}' has no 'src'")
+            src = os.path.join(os.path.dirname(parameters["src"]), task["src"])
+            if not os.path.exists(src):
+                raise ValueError(f"Sub-task config '{src}' of '{parameters['name']}' does not exist")
+
+    def create_sub_task(self, lazy_task: LazyTask) -> Task:
+        sub_task = lazy_task.create()
+        sub_task.get_output_dir = (lambda s: (lambda: self._sub_output_dir(s)))(sub_task)
+        if self.scheduler:
+            sub_task.set_scheduler(self.scheduler)
+        return sub_task
+
+    def evaluate_sub_task(self, lazy_task: LazyTask, agent: Agent) -> Tuple[str, Dict[str, Any]]:
+        sub_task = self.create_sub_task(lazy_task)
+        try:
+            return sub_task.name, sub_task.evaluate(agent)
+        finally:
+            lazy_task.release()
 
     def evaluate(self, agent: Agent) -> Dict[str, Dict[str, Any]]:
         print(f"Evaluating Composite Task '{self.name}' ...")
         results = {}
-        for task in self.tasks:
-            result = task.evaluate(agent)
-            results[task.name] = result
+        if self.scheduler:
+            # sub-tasks share the scheduler's workers, so run them side by side
+            with ThreadPoolExecutor(max_workers=len(self.tasks) or 1) as executor:
+                futures = [executor.submit(self.evaluate_sub_task, task, agent) for task in self.tasks]
+            for future in futures:
+                name, result = future.result()
+                results[name] = result
+        else:
+            for task in self.tasks:
+                name, result = self.evaluate_sub_task(task, agent)
+                results[name] = result
         self.save_metrics_all(results)
         return results
 
@@ -1,3 +1,4 @@
+import ast
 from typing import Callable
 
 from .Interaction import Container
@@ -6,6 +7,8 @@ from src.task import Task, Dataset, DataPiece, Session
 
 
 class DBBench(Task[dict, (str, str, list), str]):
+    expected_item_cost = 5.0  # up to max_round turns per item
+
     def __init__(self, **configs):
         super().__init__(**configs)
         self.data_file = configs.pop("data_file")
@@ -13,6 +16,16 @@ class DBBench(Task[dict, (str, str, list), str]):
         self.container = Container()
         self.conn = self.container.conn
 
+    @classmethod
+    def validate_config(cls, parameters):
+        super().validate_config(parameters)
+        if "data_file" not in parameters:
+            raise ValueError(f"Task '{parameters['name']}' needs a 'data_file'")
+
+    def release(self):
+        if not self.container.deleted:
+            self.container.delete()
+
     def escape(self, string: str):
         if type(string) is not str:
             string = str(string)
@@ -100,6 +113,11 @@ COMMIT;
         container.execute(f"drop database `{db}`")
         return str(answer), entry["type"][0], session.history
 
+    def deserialize_output(self, output) -> (str, str, list):
+        if isinstance(output, str):  # `serialize` writes tuples with str()
+            output = ast.literal_eval(output)
+        return tuple(output)
+
     def metrics(self) -> dict[str, Callable[[list[(str, str, list)], list[str]], float]]:
         def factory(typ):
             def acc(inp: list[(str, str, list)], tar: list[str]) -> float:
@@ -28,3 +28,6 @@ class ExampleTask(Task[str, str, str]):
 
     def predict_single(self, session: Session, data_item: str) -> str:
         return session.action({"role": "user", "content": data_item})
+
+    async def apredict_single(self, session: Session, data_item: str) -> str:
+        return await session.aaction({"role": "user", "content": data_item})
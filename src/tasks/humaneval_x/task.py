@@ -59,6 +59,7 @@ class HumanEvalXTask(Task[Dict, str, Dict]):
 
 class HumanEvalXGenerationTask(HumanEvalXTask):
     def __init__(self, name=None, workers=1, language=None, num_samples=None, datapath=None, **kwargs):
+        kwargs.setdefault("stop", None if language == "js" else "code_block")  # js code may continue after the fence
         super().__init__(name, workers, num_samples, datapath, **kwargs)
         self.language = language
 
@@ -76,6 +77,13 @@ class HumanEvalXGenerationTask(HumanEvalXTask):
     
     def predict_single(self, session: Session, data_item: Dict):
         result = session.action({"role": "user", "content": data_item['input']})
+        return self.postprocess(result, data_item)
+
+    async def apredict_single(self, session: Session, data_item: Dict):
+        result = await session.aaction({"role": "user", "content": data_item['input']})
+        return self.postprocess(result, data_item)
+
+    def postprocess(self, result: str, data_item: Dict) -> str:
         result = parse_code_from_chat(result, data_item['prompt'], self.language)
         result = cleanup_code(result, self.language)
         return result
@@ -107,6 +115,13 @@ class HumanEvalXTranslationTask(HumanEvalXTask):
     
     def predict_single(self, session: Session, data_item: Dict):
         result = session.action({"role": "user", "content": data_item['input']})
+        return self.postprocess(result, data_item)
+
+    async def apredict_single(self, session: Session, data_item: Dict):
+        result = await session.aaction({"role": "user", "content": data_item['input']})
+        return self.postprocess(result, data_item)
+
+    def postprocess(self, result: str, data_item: Dict) -> str:
         result = parse_code_from_chat(result, data_item['prompt'], self.tgt_lang)
         result = cleanup_code(result, self.tgt_lang)
         return result
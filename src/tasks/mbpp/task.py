@@ -9,6 +9,8 @@ from .utils import stream_jsonl
 from .evaluator.evaluate import evaluate_functional_correctness
 
 class MBPPTask(Task[str, str, Dict]):
+    stop = "code_block"  # postprocess keeps only the first fenced block
+
     @property
     def metrics(self) -> Dict[str, Callable[[List[str], List[Dict]], float]]:
         def evaluate(results, targets):
@@ -55,6 +57,13 @@ class MBPPTask(Task[str, str, Dict]):
 
     def predict_single(self, session: Session, data_item: str):
         result = session.action({"role": "user", "content": data_item})
+        return self.postprocess(result)
+
+    async def apredict_single(self, session: Session, data_item: str):
+        result = await session.aaction({"role": "user", "content": data_item})
+        return self.postprocess(result)
+
+    def postprocess(self, result: str) -> str:
         md_pos = result.find('```')
         if md_pos != -1:
             result = result[md_pos:].split('\n', 1)[1]
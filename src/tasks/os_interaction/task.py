@@ -123,6 +123,8 @@ class JudgeConfig:
 
 
 class OSInteraction(Task):
+    expected_item_cost = 8.0  # up to round_limit turns plus a container per item
+
     def _load_configs(self, config_path, script_root_dir=".") -> List[JudgeConfig]:
         def load_script(script_obj):
             if script_obj is None:
@@ -7,8 +7,6 @@ import jsonlines
 import random
 
 import numpy as np
-from pandas._config import config
-import torch
 
 from typing import List, Union
 from abc import ABC, abstractmethod
@@ -18,7 +16,7 @@ from .prompt import create_prompt_generator
 
 from copy import deepcopy
 
-class EvaluationDataset(torch.utils.data.Dataset, ABC):
+class EvaluationDataset(ABC):
     """
     Jsonlines of {
         "text": context
@@ -14,6 +14,7 @@ import datetime
 from src.task import Task, Session
 from src.tasks.single_round_tasks.configs import BaseConfig
 from src.utils import print_rank_0, JsonEncoder
+from src.sink import get_sink, read_lines
 from src.agent import Agent, Session
 from src.tasks.single_round_tasks.dataset import GenerationTaskDataset
 from src.tasks.single_round_tasks.metrics import DEFAULT_METRICS
@@ -27,6 +28,11 @@ class SingleRoundTask(Task[str, str, str]):
         super().__init__(**kwargs)
         self.file_groups = self.get_file_groups()
 
+    @classmethod
+    def validate_config(cls, parameters):
+        super().validate_config(parameters)
+        BaseConfig.from_dict(parameters)
+
     def get_file_groups(self):
         pattern_group = {}
         if isinstance(self.config.file_pattern, str):
@@ -55,21 +61,25 @@ class SingleRoundTask(Task[str, str, str]):
             result_dict_group = {}
             for file in filelist:
                 dataset = self.build_dataset(file)
-                inputs = [piece["text"] for piece in dataset]
-                raw_results = self.predict_all(agent, inputs)
-
-                # first stage: get model predictions
-                for data, raw_result in zip(dataset.data, raw_results):
-                    data["raw_answer"] = raw_result
-                    data["prediction"] = raw_result
-
-                # second stage: extract answer
-                if self.config.extract_answer == True:
-                    extract_outputs = self.extract_answer(dataset, agent)
-                    for data, result in zip(dataset.data, extract_outputs):
-                        data["prediction"] = result
-
-                if self.config.save_prediction:  # first save and evaluate
+                restored = self.resume and self.load_prediction_from_file(file, dataset.data, agent.name)
+                if restored:
+                    print_rank_0(f"        Resumed {file} from its prediction file")
+                else:
+                    inputs = [piece["text"] for piece in dataset]
+                    raw_results = self.predict_all(agent, inputs)
+
+                    # first stage: get model predictions
+                    for data, raw_result in zip(dataset.data, raw_results):
+                        data["raw_answer"] = raw_result
+                        data["prediction"] = raw_result
+
+                    # second stage: extract answer
+                    if self.config.extract_answer == True:
+                        extract_outputs = self.extract_answer(dataset, agent)
+                        for data, result in zip(dataset.data, extract_outputs):
+                            data["prediction"] = result
+
+                if self.config.save_prediction and not restored:  # first save and evaluate
                     self.save_prediction_to_file(file, dataset.data, agent.name)
 
                 try:
@@ -121,14 +131,33 @@ class SingleRoundTask(Task[str, str, str]):
     def build_dataset(self, relative_path):
         return GenerationTaskDataset(os.path.join(self.config.path, relative_path), self.config)
 
-    def save_prediction_to_file(self, file, data, agent_name):
+    def get_prediction_file(self, file, agent_name):
         file = ".".join(file.split(".")[:-1])
-        filename = os.path.join(self.get_output_dir(), agent_name, "prediction", f"{agent_name}.{file}.predict.jsonl")
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "w") as file:
-            for output_data in data:
-                json.dump(output_data, file, ensure_ascii=False)
-                file.write('\n')
+        return os.path.join(self.get_output_dir(), agent_name, "prediction", f"{agent_name}.{file}.predict.jsonl")
+
+    def load_prediction_from_file(self, file, data, agent_name) -> bool:
+        """
+            Restore raw answers and predictions of a finished file, if its prediction file matches `data` item by item.
+        """
+        try:
+            saved = [json.loads(line) for line in read_lines(self.get_prediction_file(file, agent_name)) if line.strip()]
+        except json.JSONDecodeError:
+            return False
+        if len(saved) != len(data) or any(
+            item.get("text") != target["text"] or "prediction" not in item
+            for item, target in zip(saved, data)
+        ):
+            return False
+        for item, target in zip(saved, data):
+            target["raw_answer"] = item.get("raw_answer")
+            target["prediction"] = item["prediction"]
+        return True
+
+    def save_prediction_to_file(self, file, data, agent_name):
+        sink = get_sink(self.get_prediction_file(file, agent_name), "w")
+        for output_data in data:
+            sink.write(json.dumps(output_data, ensure_ascii=False) + '\n')
+        sink.close()
 
     def save_evaluation_to_file(self, file, res_dict, agent_name):
         file = ".".join(file.split(".")[:-1])
@@ -140,6 +169,9 @@ class SingleRoundTask(Task[str, str, str]):
 
     def save_overall_results(self, result_dict_all, cal_results, agent_name):
         results_all = {"calculate": cal_results, "results": result_dict_all}
+        timings = self.get_timing_summary()
+        if timings:
+            results_all["timings"] = timings
         filename = os.path.join(self.get_output_dir(), agent_name, "results.json")
         with open(filename, "w", encoding="utf-8") as f:
             f.write(json.dumps(results_all, cls=JsonEncoder, indent=2))
@@ -260,6 +292,9 @@ class SingleRoundTask(Task[str, str, str]):
     def predict_single(self, session: Session, data_item: str) -> str:
         return session.action({"role": "user", "content": data_item})
 
+    async def apredict_single(self, session: Session, data_item: str) -> str:
+        return await session.aaction({"role": "user", "content": data_item})
+
     @property
     def metrics(self):
         return DEFAULT_METRICS
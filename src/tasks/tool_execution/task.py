@@ -71,6 +71,8 @@ class ToolPrediction:
 
 
 class ToolExecution(Task[ToolEvaluationData, ToolPrediction, ToolEvaluationData]):
+    expected_item_cost = 3.0  # choosing, calling and reasoning stages
+
     def _load_glob_data(self, glob_dir):
         configs = []
         for dir_path in glob.glob(glob_dir):
@@ -236,6 +238,16 @@ class ToolExecution(Task[ToolEvaluationData, ToolPrediction, ToolEvaluationData]
             ret.append(DataPiece(item, item))
         return ret
 
+    def deserialize_output(self, output) -> Optional[ToolPrediction]:
+        if output is None:
+            return None
+        result = ToolPrediction(Session(None, output["session"]["history"]), output["query"],
+                                output["additional_information"])
+        for key in ("choosing", "calling", "reasoning", "message"):
+            if key in output:  # attributes still at their class default are not serialized
+                setattr(result, key, output[key])
+        return result
+
     def predict_single(self, session: Session, data_item: ToolEvaluationData):
         result = ToolPrediction(session, data_item.query, data_item.additional_information)
         for _ in range(0, 3):
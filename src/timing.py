@@ -0,0 +1,219 @@
+import time
+import contextvars
+from contextlib import contextmanager
+from typing import List, Dict, Any, Callable, Optional
+
+import numpy as np
+
+_current_item = contextvars.ContextVar("timing_item", default=None)
+_current_call = contextvars.ContextVar("timing_call", default=None)
+
+
+def estimate_tokens(chars: int) -> int:
+    """
+        Rough token count (about 4 characters per token), since the harness has no tokenizer for API models.
+    """
+    return (chars + 3) // 4
+
+
+def history_chars(history: List[dict]) -> int:
+    return sum(len(message.get("content") or "") for message in history)
+
+
+class ItemTimer:
+    """
+        Timings of one `predict_single` call and of every `Session.action` made inside it.
+    """
+
+    def __init__(self, index: int, submitted: float) -> None:
+        self.index = index
+        self.submitted = submitted
+        self.started = None
+        self.finished = None
+        self.failed = False
+        self.calls: List[Dict[str, Any]] = []
+
+    @property
+    def queue_wait(self) -> float:
+        return self.started - self.submitted
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+    @property
+    def model_latency(self) -> Optional[float]:
+        """
+            Mean time per model call, None if the item made no calls.
+        """
+        if not self.calls:
+            return None
+        return sum(call["model_time"] for call in self.calls) / len(self.calls)
+
+    @property
+    def retries(self) -> int:
+        return sum(call["retries"] for call in self.calls)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "queue_wait": self.queue_wait,
+            "duration": self.duration,
+            "failed": self.failed,
+            "calls": self.calls,
+        }
+
+
+@contextmanager
+def track_item(index: int, submitted: float):
+    item = ItemTimer(index, submitted)
+    item.started = time.time()
+    token = _current_item.set(item)
+    try:
+        yield item
+    except BaseException:
+        item.failed = True
+        raise
+    finally:
+        item.finished = time.time()
+        _current_item.reset(token)
+
+
+@contextmanager
+def track_call(history: List[dict]):
+    """
+        Record one model call made from `Session.action`; the caller fills in `response`.
+    """
+    prompt_chars = history_chars(history)
+    record = {
+        "wall_time": 0.0,
+        "model_time": 0.0,
+        "prompt_chars": prompt_chars,
+        "prompt_tokens": estimate_tokens(prompt_chars),
+        "response_chars": 0,
+        "response_tokens": 0,
+        "retries": 0,
+    }
+    token = _current_call.set(record)
+    start = time.time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__  # the agent gave up, after its retries
+        raise
+    finally:
+        record["wall_time"] = time.time() - start
+        _current_call.reset(token)
+        item = _current_item.get()
+        if item is not None:
+            item.calls.append(record)
+
+
+@contextmanager
+def detached_call():
+    """
+        Run without a call record, for duplicate requests that should not add to the item's timings.
+    """
+    token = _current_call.set(None)
+    try:
+        yield
+    finally:
+        _current_call.reset(token)
+
+
+def set_response(record: Dict[str, Any], response: Optional[str]) -> None:
+    if isinstance(response, str):
+        record["response_chars"] = len(response)
+        record["response_tokens"] = estimate_tokens(len(response))
+
+
+def record_retry() -> None:
+    """
+        Called by agents each time they retry a request.
+    """
+    record = _current_call.get()
+    if record is not None:
+        record["retries"] += 1
+
+
+def record_early_stop() -> None:
+    """
+        Called by streaming agents when they close the stream because the stop predicate matched.
+    """
+    record = _current_call.get()
+    if record is not None:
+        record["early_stop"] = True
+
+
+def record_first_token(latency: float) -> None:
+    """
+        Called by streaming agents when the first output of a request arrives, `latency` seconds after it was sent.
+    """
+    record = _current_call.get()
+    if record is not None:
+        record["first_token_time"] = latency
+
+
+def timed(inference: Callable) -> Callable:
+    """
+        Wrap the innermost `inference` so the time spent in the model itself is told apart from the layers above it.
+    """
+    def wrapper(history):
+        start = time.time()
+        try:
+            return inference(history)
+        finally:
+            record = _current_call.get()
+            if record is not None:
+                record["model_time"] += time.time() - start
+    return wrapper
+
+
+def atimed(ainference: Callable) -> Callable:
+    async def wrapper(history):
+        start = time.time()
+        try:
+            return await ainference(history)
+        finally:
+            record = _current_call.get()
+            if record is not None:
+                record["model_time"] += time.time() - start
+    return wrapper
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": float(np.mean(values)), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def summarize(items: List[ItemTimer], wall_time: float) -> Dict[str, Any]:
+    """
+        Aggregate item timings into the summary stored in results.json. `overhead` is the part of each item not spent
+        inside the model (task logic and agent layers, queue wait excluded).
+    """
+    calls = [call for item in items for call in item.calls]
+    return {
+        "items": len(items),
+        "requests": len(calls),
+        "wall_time": wall_time,
+        "items_per_sec": len(items) / wall_time if wall_time else 0,
+        "requests_per_sec": len(calls) / wall_time if wall_time else 0,
+        "retries": sum(call["retries"] for call in calls),
+        "failed_requests": sum("error" in call for call in calls),
+        "failed_items": sum(item.failed for item in items),
+        "early_stops": sum(call.get("early_stop", False) for call in calls),
+        "prompt_tokens": sum(call["prompt_tokens"] for call in calls),
+        "response_tokens": sum(call["response_tokens"] for call in calls),
+        "latency": {
+            "request": percentiles([call["wall_time"] for call in calls]),
+            "model": percentiles([call["model_time"] for call in calls]),
+            "first_token": percentiles([call["first_token_time"] for call in calls if "first_token_time" in call]),
+            "queue_wait": percentiles([item.queue_wait for item in items]),
+            "item": percentiles([item.duration for item in items]),
+            "overhead": percentiles([
+                item.duration - sum(call["model_time"] for call in item.calls) for item in items
+            ]),
+        },
+    }
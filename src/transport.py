@@ -0,0 +1,154 @@
+import asyncio
+import threading
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TRANSPORT_CONFIG = {
+    "pool_size": 10,  # keep-alive connections per host, evaluate.py sets it to --workers
+    "connect_timeout": 10.0,
+    "read_timeout": 120.0,
+}
+
+
+def configure_transport(**config) -> None:
+    for key, value in config.items():
+        if key not in TRANSPORT_CONFIG:
+            raise ValueError(f"Unknown transport option '{key}'")
+        if value is not None:
+            TRANSPORT_CONFIG[key] = value
+
+
+class Transport:
+    """
+        Keep-alive HTTP connections shared by every agent: one `requests.Session` per host with a pool of
+        `pool_size` connections, and one `aiohttp.ClientSession` per event loop for the async path.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, requests.Session] = {}
+        self.async_sessions: Dict[int, "aiohttp.ClientSession"] = {}
+        self.async_stats: Dict[str, Dict[str, int]] = {}
+
+    def session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TRANSPORT_CONFIG["pool_size"])
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    @staticmethod
+    def timeout(timeout=None):
+        return timeout or (TRANSPORT_CONFIG["connect_timeout"], TRANSPORT_CONFIG["read_timeout"])
+
+    @staticmethod
+    def with_read_timeout(read_timeout: Optional[float]) -> tuple:
+        """
+            `timeout` of `post` for an agent with a read timeout of its own; None waits as long as the server takes.
+        """
+        return TRANSPORT_CONFIG["connect_timeout"], read_timeout
+
+    @staticmethod
+    def async_timeout(read_timeout: Optional[float]) -> "aiohttp.ClientTimeout":
+        """
+            The same for a request of the async session.
+        """
+        import aiohttp
+        return aiohttp.ClientTimeout(sock_connect=TRANSPORT_CONFIG["connect_timeout"], sock_read=read_timeout)
+
+    def request(self, method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+        return self.session(url).request(method, url, timeout=self.timeout(timeout), **kwargs)
+
+    def post(self, url: str, timeout=None, **kwargs) -> requests.Response:
+        return self.request("POST", url, timeout, **kwargs)
+
+    def async_session(self) -> "aiohttp.ClientSession":
+        """
+            The client session of the running event loop; sessions cannot be shared across loops.
+        """
+        import aiohttp  # only async agents need it
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            session = self.async_sessions.get(id(loop))
+            if session is None or session.closed:
+                trace = aiohttp.TraceConfig()
+                trace.on_request_start.append(self._on_request)
+                trace.on_connection_create_end.append(self._on_connection)
+                session = aiohttp.ClientSession(
+                    trace_configs=[trace],
+                    connector=aiohttp.TCPConnector(limit=TRANSPORT_CONFIG["pool_size"],  # aiohttp's default is 100
+                                                   limit_per_host=TRANSPORT_CONFIG["pool_size"]),
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=TRANSPORT_CONFIG["connect_timeout"],
+                        sock_read=TRANSPORT_CONFIG["read_timeout"],
+                    ),
+                )
+                self.async_sessions[id(loop)] = session
+            return session
+
+    def _count(self, host: str, key: str) -> None:
+        with self.lock:
+            stats = self.async_stats.setdefault(host, {"requests": 0, "connections": 0})
+            stats[key] += 1
+
+    async def _on_request(self, session, context, params) -> None:
+        context.host = urlsplit(str(params.url)).netloc
+        self._count(context.host, "requests")
+
+    async def _on_connection(self, session, context, params) -> None:
+        self._count(context.host, "connections")
+
+    async def aclose(self) -> None:
+        """
+            Close the running loop's client session, called before the loop ends.
+        """
+        with self.lock:
+            session = self.async_sessions.pop(id(asyncio.get_running_loop()), None)
+        if session is not None:
+            await session.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            adapter = session.get_adapter("http://" + host)
+            requests_count = connections = 0
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    requests_count += pool.num_requests
+                    connections += pool.num_connections
+            stats[host] = {
+                "requests": requests_count,
+                "connections": connections,
+            }
+        with self.lock:
+            for host, counts in self.async_stats.items():
+                host_stats = stats.setdefault(host, {"requests": 0, "connections": 0})
+                host_stats["requests"] += counts["requests"]
+                host_stats["connections"] += counts["connections"]
+        for host_stats in stats.values():
+            host_stats["reuse_rate"] = 1 - host_stats["connections"] / host_stats["requests"] \
+                if host_stats["requests"] else 0
+            host_stats["pool_size"] = TRANSPORT_CONFIG["pool_size"]
+        return stats
+
+
+_transport: Optional[Transport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+        return _transport
@@ -3,8 +3,6 @@ import requests
 import random
 import logging
 import json
-import torch
-import torch.distributed as dist
 import numpy as np
 
 # from SwissArmyTransformer import mpu, get_tokenizer
@@ -46,6 +44,8 @@ def print_rank_0(*args, **kwargs):
 
 
 def build_data_loader(dataset, micro_batch_size, num_workers, drop_last, collate_fn=None):
+    import torch  # imported here so that `import src` does not load torch
+
     # Sampler.
     '''
     world_size = mpu.get_data_parallel_world_size()
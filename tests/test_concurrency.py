@@ -0,0 +1,55 @@
+import heapq
+import math
+import random
+
+from src.concurrency import AdaptiveLimiter
+
+
+def lognormal(mean: float, std: float):
+    sigma = math.sqrt(math.log(1 + (std / mean) ** 2))
+    return lambda rng, inflight: rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+
+
+def simulate(latency, items: int = 600, workers: int = 32, seed: int = 0) -> dict:
+    """
+        Run `items` calls through the limiter on a simulated clock; `latency(rng, inflight)` draws one call's duration.
+    """
+    rng = random.Random(seed)
+    limiter = AdaptiveLimiter(1, workers)
+    now, running, started = 0.0, [], 0
+    for _ in range(items):
+        while started < items and len(running) < limiter.current:
+            duration = latency(rng, len(running) + 1)
+            heapq.heappush(running, (now + duration, duration))
+            started += 1
+        now, duration = heapq.heappop(running)
+        limiter.update(duration)
+    return limiter.get_stats()
+
+
+def test_variable_latency_without_load_keeps_the_limit_high():
+    for seed in range(5):
+        stats = simulate(lognormal(2.0, 1.5), seed=seed)
+        assert stats["peak"] == 32
+        assert stats["mean"] > 20
+        assert stats["decreases"] <= 2
+
+
+def test_constant_latency_reaches_the_maximum():
+    stats = simulate(lambda rng, inflight: 1.0)
+    assert stats["final"] == 32 and stats["decreases"] == 0
+
+
+def test_latency_that_grows_with_load_lowers_the_limit():
+    base = lognormal(2.0, 1.5)
+    for seed in range(5):
+        stats = simulate(lambda rng, inflight: base(rng, inflight) * max(1.0, inflight / 8), seed=seed)
+        assert stats["decreases"] > 0
+        assert 8 <= stats["final"] <= 24
+
+
+def test_failures_cut_the_limit():
+    limiter = AdaptiveLimiter(1, 32, initial=16)
+    limiter.since_decrease = 16
+    limiter.update(1.0, failed=True)
+    assert limiter.current == 11